@@ -11,6 +11,9 @@ setup(
     package_dir={"": "src"},  # Map package root to src directory
     include_package_data=True,
     install_requires=load_requirements(),
+    extras_require={
+        'parquet': ['pyarrow>=12.0.0'],  # parquet output of the scorer, see FrameAxis.save_scores_parquet
+    },
     entry_points={
         'console_scripts': [
             'collect=data_collection.collect_data:main',  # Update to match the package path
@@ -0,0 +1,146 @@
+import argparse
+import io
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+from gensim.models import KeyedVectors
+
+from embedding_subset import dictionary_tokens
+from frameAxis import DICT_TYPES, FrameAxis
+from preprocess.preprocess import preprocess, stop_words
+
+LETTERS = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+NOISE = ['https://www.reddit.com/r/politics/comments/abc123', 'http://t.co/xyz', '\U0001F600', '\U0001F1FA\U0001F1F8',
+         '&amp;', '!!', '...', '?', '#2024', '@someone']
+
+
+def synthetic_model(n_words=50000, dim=300, seed=0):
+    """
+    Random KeyedVectors holding every word of the moral foundation dictionaries, so that all the dict types can build
+    their axes, plus n_words random lowercase words.
+    """
+    rng = np.random.default_rng(seed)
+    words = sorted(dictionary_tokens())
+    lengths = rng.integers(3, 11, n_words)
+    letters = LETTERS[rng.integers(0, 26, lengths.sum())]
+    filler = [''.join(chars) for chars in np.split(letters, np.cumsum(lengths)[:-1])]
+    known = set(words)
+    words += [word for word in dict.fromkeys(filler) if word not in known]
+    model = KeyedVectors(dim)
+    model.add_vectors(words, rng.standard_normal((len(words), dim)).astype(np.float32))
+    return model
+
+
+def synthetic_corpus(model, n_docs=20000, mean_len=60, seed=1):
+    """
+    Reddit-like posts: Zipf distributed words of the model mixed with stop words, capitals, urls, emojis,
+    punctuation and out of vocabulary words, with a few empty and missing posts.
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(model.index_to_key, dtype=object)
+    # a random rank for every word, so that the frequent words are not only the dictionary ones
+    ranked = vocab[rng.permutation(len(vocab))]
+    lengths = rng.lognormal(np.log(mean_len), 0.8, n_docs).astype(np.int64)
+    n_tokens = lengths.sum()
+    tokens = ranked[np.minimum(rng.zipf(1.3, n_tokens), len(ranked)) - 1]
+    kind = rng.random(n_tokens)
+    stop = kind < 0.3
+    tokens[stop] = rng.choice(stop_words[1:], stop.sum())
+    noise = (kind >= 0.3) & (kind < 0.33)
+    tokens[noise] = rng.choice(NOISE, noise.sum())
+    capital = (kind >= 0.33) & (kind < 0.38)
+    tokens[capital] = [token.capitalize() for token in tokens[capital]]
+    docs = [' '.join(doc) for doc in np.split(tokens, np.cumsum(lengths)[:-1])]
+    df = pd.DataFrame({'id': np.arange(n_docs), 'subreddit': rng.choice(['politics', 'news', 'conservative'], n_docs),
+                       'selftext': docs})
+    df.loc[rng.choice(n_docs, max(n_docs // 1000, 1), replace=False), 'selftext'] = np.nan
+    return df
+
+
+class Benchmark:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+
+    @contextmanager
+    def stage(self, name, n_docs=None):
+        """Times the stage and records its peak traced memory, silencing the prints of the scoring code"""
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            yield
+        seconds = time.perf_counter() - start
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        result = {'stage': name, 'seconds': round(seconds, 4), 'docs': n_docs,
+                  'docs_per_sec': round(n_docs / seconds, 1) if n_docs else None,
+                  'peak_mb': round(peak, 1) if peak is not None else None}
+        self.results.append(result)
+        print(f"{name:<32}{seconds:>10.3f}s" + (f"{result['docs_per_sec']:>14.1f} docs/s" if n_docs else ' ' * 21) +
+              (f"{peak:>12.1f} MB" if peak is not None else ''))
+
+
+def run(n_docs=20000, n_words=50000, dim=300, dict_types=DICT_TYPES, n_jobs=1, trace_memory=True):
+    bench = Benchmark(trace_memory)
+    with bench.stage('synthetic model'):
+        model = synthetic_model(n_words, dim)
+    with bench.stage('synthetic corpus'):
+        df = synthetic_corpus(model, n_docs)
+    print(f'{len(model.index_to_key)} words of dimension {dim}, {n_docs} docs\n')
+
+    with bench.stage('preprocess', n_docs):
+        docs = preprocess(df['selftext'], n_jobs=n_jobs).reset_index(drop=True)
+
+    for dict_type in dict_types:
+        with bench.stage(f'axes {dict_type}'):
+            fa = FrameAxis(mfd=dict_type, w2v_model=model)
+        with bench.stage(f'projections {dict_type}'):
+            fa.projections
+        with bench.stage(f'doc_scores {dict_type}', n_docs):
+            bias, intensity = fa.doc_scores(docs, [])
+        with bench.stage(f'doc_scores top_k=5 {dict_type}', n_docs):
+            fa.doc_scores(docs, [], top_k=5)
+        with bench.stage(f'doc_scores tfidf {dict_type}', n_docs):
+            fa.doc_scores(docs, [], tfidf=True)
+        with bench.stage(f'virtue_vice {dict_type}', n_docs):
+            fa.virtue_vice_scores(pd.concat([bias, intensity], axis=1))
+
+    if len(dict_types) > 1:
+        with bench.stage('axes all dicts'):
+            fa = FrameAxis(mfd=dict_types, w2v_model=model)
+        with bench.stage('projections all dicts'):
+            for group, _ in fa.groups or [(fa, None)]:
+                group.projections
+        # from the raw posts, which get preprocessed once per group of dictionaries with different multiword entries
+        with bench.stage('get_fa_scores all dicts', n_docs):
+            fa.get_fa_scores(df, 'selftext', format='bias_intensity')
+
+    print(f'\nmax resident memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10:.1f} MB')
+    return bench.results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the FrameAxis scoring path on synthetic data, offline.')
+    parser.add_argument('--n_docs', type=int, default=20000, help='number of synthetic posts')
+    parser.add_argument('--n_words', type=int, default=50000, help='random words added to the dictionary words')
+    parser.add_argument('--dim', type=int, default=300, help='dimension of the synthetic word vectors')
+    parser.add_argument('--dict_types', nargs='+', default=DICT_TYPES, choices=DICT_TYPES)
+    parser.add_argument('--n_jobs', type=int, default=1, help='preprocessing processes')
+    parser.add_argument('--no_trace_memory', action='store_true',
+                        help='skip tracemalloc, which slows down the pure python stages')
+    parser.add_argument('--output', help='json file to write the results to')
+    args = parser.parse_args()
+
+    results = run(args.n_docs, args.n_words, args.dim, args.dict_types, args.n_jobs, not args.no_trace_memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f, indent=2)
+        print(f'Results saved to {args.output}')
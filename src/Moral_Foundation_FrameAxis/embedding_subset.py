@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from gensim.models import KeyedVectors
+
+from frameAxis import DICT_TYPES, FrameAxis
+from preprocess.preprocess import preprocess
+
+
+def corpus_tokens(input_file: str, docs_col: str, chunksize: int = 100000) -> set:
+    """Unique tokens of the preprocessed corpus, read chunk by chunk so the csv never has to fit in memory."""
+    tokens = set()
+    for chunk in pd.read_csv(input_file, on_bad_lines='skip', encoding='utf-8', usecols=[docs_col],
+                             chunksize=chunksize):
+        for doc in preprocess(chunk[docs_col]):
+            tokens.update(doc.split())
+    return tokens
+
+
+def dictionary_tokens() -> set:
+    """Words of all the moral foundation dictionaries, so that every dict_type can build its axes from the subset."""
+    tokens = set()
+    for dict_type in DICT_TYPES:
+        tokens.update(FrameAxis.read_dictionary(dict_type)['word'].dropna().astype(str))
+    return tokens
+
+
+def input_fingerprint(input_file: str, docs_col: str) -> dict:
+    """Identifies the corpus a subset was built from, by the path, size and modification time of the csv."""
+    stat = os.stat(input_file)
+    return {'input_file': os.path.abspath(input_file), 'docs_col': docs_col, 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def fingerprint_path(output_path: str) -> str:
+    return f'{output_path}.input.json'
+
+
+def subset_is_current(output_path: str, input_file: str, docs_col: str) -> bool:
+    """
+    Whether the subset at output_path was built from input_file as it is now. Tokens added to the corpus since
+    would be missing from the subset and scored as out of vocabulary, so a stale subset has to be rebuilt.
+    """
+    try:
+        with open(fingerprint_path(output_path)) as f:
+            return json.load(f) == input_fingerprint(input_file, docs_col)
+    except FileNotFoundError:
+        return False
+
+
+def build_embedding_subset(model, input_file: str, docs_col: str, output_path: str, chunksize: int = 100000):
+    """
+    Writes a compact copy of model that only holds the vectors used by the corpus and the dictionaries.
+    Words keep their relative order from the full model. The subset is saved in gensim's native format and
+    returned memory-mapped, see MoralFoundationScorer.setup_model. The fingerprint of input_file is saved next to
+    it, see subset_is_current.
+    """
+    fingerprint = input_fingerprint(input_file, docs_col)
+    needed = corpus_tokens(input_file, docs_col, chunksize) | dictionary_tokens()
+    ids = np.sort(np.fromiter((model.key_to_index[token] for token in needed if token in model.key_to_index),
+                              dtype=np.int64))
+    print(f'Keeping {len(ids)} of {len(model.index_to_key)} word vectors '
+          f'({len(needed) - len(ids)} corpus and dictionary tokens are not in the model)')
+
+    subset = KeyedVectors(model.vector_size, dtype=model.vectors.dtype)
+    subset.add_vectors([model.index_to_key[i] for i in ids], model.vectors[ids])
+    subset.save(output_path, separately=['vectors'])
+    with open(fingerprint_path(output_path), 'w') as f:
+        json.dump(fingerprint, f)
+    print(f'Embedding subset saved at {output_path}')
+    return KeyedVectors.load(output_path, mmap='r')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a corpus-pruned copy of a word embedding model.')
+    parser.add_argument('--model_path', required=True, help='word2vec binary or native .kv model')
+    parser.add_argument('--input_file', required=True, help='csv file with the documents to score')
+    parser.add_argument('--docs_col', required=True, help='column of input_file holding the documents')
+    parser.add_argument('--output_path', required=True, help='where to save the subset, e.g. ./data/subset.kv')
+    args = parser.parse_args()
+
+    if args.model_path.endswith('.kv'):
+        full_model = KeyedVectors.load(args.model_path, mmap='r')
+    else:
+        full_model = KeyedVectors.load_word2vec_format(args.model_path, binary=True)
+    build_embedding_subset(full_model, args.input_file, args.docs_col, args.output_path)
@@ -1,43 +1,186 @@
 import os
+import time
 from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool, shared_memory
 from pathlib import Path
+from types import SimpleNamespace
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+from metrics import RunMetrics
+from preprocess.phrases import PhraseMatcher
 from preprocess.preprocess import preprocess
+from projection_cache import ProjectionCache
+
+DICT_TYPES = ["emfd", "mfd", "mfd2", "customized"]
+FRAME_PREFIXES = ('bias_', 'intensity_', 'top_tokens_')  # column prefixes of the frames of doc_scores
 
 
 class FrameAxis:
-    def __init__(self, mfd=None, w2v_model=None):
+    def __init__(self, mfd=None, w2v_model=None, cache_dir=None, axes=None, projections=None, metrics=None,
+                 phrases=None):
+        """
+        :param mfd: dictionary type, or a list of them to score all their axes in one pass over the docs, the axes
+            (and so the output columns) are then named {dict_type}_{mf}, e.g. bias_mfd_care or emfd_care.virtue
+        :param axes, projections: already built axes and their projection table, the scoring workers use these
+            with a vocabulary-only w2v_model (key_to_index and index_to_key) instead of rebuilding them
+        :param metrics: RunMetrics recording the stages of the run, written next to the output by get_fa_scores
+        :param phrases: PhraseMatcher of the dictionaries' multiword entries. By default every dictionary only
+            merges its own entries, so that its scores are the same as when it is scored alone: get_fa_scores then
+            preprocesses the docs once per distinct set of entries (see groups), e.g. once for emfd, mfd and
+            customized, which have none, and once for mfd2. Passing a PhraseMatcher tokenizes the docs once, alike
+            for all the dictionaries, e.g. the one of their merged entries
+        """
+        self.metrics = metrics or RunMetrics()
         self.model = w2v_model
+        self.mfd = mfd
+        self.dict_types = self.dict_type_list(mfd)
+        self.cache_dir = cache_dir
+        self._cache = ProjectionCache(cache_dir) if cache_dir else None
+        self._projections = projections
         self.vocab = self.model.key_to_index.keys()  # for older gensim self.model.vocab
-        current_dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.oov_words = {}  # dictionary words missing from the embedding model, per axis
+        self.phrases = phrases
+        # (FrameAxis, {its axis name: axis name here}) per group of dictionaries merging the same multiword entries,
+        # empty when all the dictionaries are scored on the same tokens
+        self.groups = []
+        if axes is not None:
+            self.axes = axes
+        else:
+            with self.metrics.stage('axes'):
+                self._build_axes()
+            print('axes names: ', list(self.axes.keys()))
+
+        self.axis_index = {mf: i for i, mf in enumerate(self.axes.keys())}
+
+    @staticmethod
+    def dict_type_list(mfd):
+        """:return: the dictionary types of mfd, a single one or a list of them, without duplicates"""
+        if mfd is None or isinstance(mfd, str):
+            return [mfd]
+        return list(dict.fromkeys(mfd))
+
+    @property
+    def cache_key(self):
+        # the projection table of several dictionaries is cached under e.g. "emfd+mfd"
+        return '+'.join(self.dict_types)
+
+    def _build_axes(self):
+        prefixed = len(self.dict_types) > 1
+        self.axes, self.oov_words = {}, {}
+        words_dfs, dict_axes = {}, {}
+        for dict_type in self.dict_types:
+            words_df = self.read_dictionary(dict_type)
+            words_dfs[dict_type] = words_df
+            axes, oov_words = self._dictionary_axes(dict_type, words_df)
+            dict_axes[dict_type] = axes
+            prefix = f'{dict_type}_' if prefixed else ''
+            self.axes.update({prefix + mf: axis for mf, axis in axes.items()})
+            self.oov_words.update({prefix + mf: words for mf, words in oov_words.items()})
+        if self.phrases is None:
+            # multiword entries of the model vocabulary are merged into single tokens when preprocessing the docs
+            self.phrases = PhraseMatcher.from_dictionary(pd.concat(words_dfs.values(), ignore_index=True),
+                                                         self.model.key_to_index)
+            if len(self.phrases):
+                print(f'{len(self.phrases)} multiword {self.cache_key} entries will be matched in the docs')
+            if prefixed:
+                self.groups = self._tokenization_groups(words_dfs, dict_axes)
+
+    def _tokenization_groups(self, words_dfs, dict_axes):
+        """
+        Groups the dictionaries by their multiword entries, each group scoring its axes on the docs preprocessed
+        with its own entries only.
+        :return: (FrameAxis of the group, {its axis name: axis name here}) per group, or [] when all the
+            dictionaries have the same entries
+        """
+        matchers, groups = {}, {}
+        for dict_type, words_df in words_dfs.items():
+            matchers[dict_type] = PhraseMatcher.from_dictionary(words_df, self.model.key_to_index)
+            groups.setdefault(frozenset(matchers[dict_type].phrases()), []).append(dict_type)
+        if len(groups) < 2:
+            return []
+        tokenization_groups = []
+        for dict_types in groups.values():
+            # a group of a single dictionary is that dictionary alone, sharing its projection cache
+            prefixed = len(dict_types) > 1
+            axes, names = {}, {}
+            for dict_type in dict_types:
+                for mf, axis in dict_axes[dict_type].items():
+                    axes[f'{dict_type}_{mf}' if prefixed else mf] = axis
+                    names[f'{dict_type}_{mf}' if prefixed else mf] = f'{dict_type}_{mf}'
+            fa = FrameAxis(mfd=dict_types if prefixed else dict_types[0], w2v_model=self.model,
+                           cache_dir=self.cache_dir, axes=axes, metrics=self.metrics,
+                           phrases=matchers[dict_types[0]])
+            tokenization_groups.append((fa, names))
+        print(f'The docs will be preprocessed for each of {[fa.cache_key for fa, _ in tokenization_groups]}, '
+              f'which merge different multiword entries')
+        return tokenization_groups
+
+    def _dictionary_axes(self, dict_type, words_df):
+        """:return: the axes and out of vocabulary words of one dictionary, cached per dictionary"""
+        cached = self._cache.load_axes(self.model, dict_type, words_df) if self._cache else None
+        if cached is not None:
+            return cached
+        if dict_type == "emfd":
+            axes, oov_words = self._get_emfd_axes(words_df)
+        else:
+            axes, oov_words = self._compute_axes(words_df)
+        if self._cache:
+            self._cache.save_axes(self.model, dict_type, words_df, axes, oov_words)
+        return axes, oov_words
+
+    @property
+    def projections(self):
+        """
+        (vocab x axes) cosine similarities between every word of the model and every axis, rows follow
+        self.model.key_to_index and columns follow self.axes. Read from the projection cache when cache_dir is set.
+        """
+        if self._projections is None:
+            with self.metrics.stage('projections'):
+                if self._cache:
+                    self._projections = self._cache.load_or_build(self.model, self.cache_key, self.axes,
+                                                                  self.project_vectors)
+                else:
+                    self._projections = np.concatenate(
+                        [self.project_vectors(self.model.vectors[start:start + 100000])
+                         for start in range(0, len(self.model.vectors), 100000)]).astype(np.float32)
+        return self._projections
+
+    def preprocess(self, docs):
+        """preprocess, merging the multiword entries of the dictionary"""
+        return preprocess(docs, phrases=self.phrases)
+
+    def projection(self, token, mf):
+        return self.projections[self.model.key_to_index[token], self.axis_index[mf]]
 
+    @staticmethod
+    def read_dictionary(mfd):
+        current_dir_path = os.path.dirname(os.path.realpath(__file__))
         if mfd == "emfd":
             words_df = pd.read_csv(
                 f'{current_dir_path}/moral_foundation_dictionaries/eMFD_wordlist.csv')
-            self.axes, categories = self._get_emfd_axes(words_df)
-            print('axes names: ', categories)
+        elif mfd == "mfd":
+            words_df = pd.read_csv(
+                f'{current_dir_path}/moral_foundation_dictionaries/MFD_original.csv')
+        elif mfd == "mfd2":
+            words_df = FrameAxis.read_mfd2_into_dataframe(current_dir_path)
+        elif mfd == "customized":
+            words_df = pd.read_csv(f'{current_dir_path}/moral_foundation_dictionaries/customized.csv')
         else:
-            if mfd == "mfd":
-                words_df = pd.read_csv(
-                    f'{current_dir_path}/moral_foundation_dictionaries/MFD_original.csv')
-            elif mfd == "mfd2":
-                words_df = self.read_mfd2_into_dataframe(current_dir_path)
-            elif mfd == "customized":
-                words_df = pd.read_csv(f'{current_dir_path}/moral_foundation_dictionaries/customized.csv')
-            else:
-                raise ValueError(f'Invalid mfd value: {mfd}')
-            
-            self.axes, categories = self._compute_axes(words_df)
-            print('axes names: ', categories)
-
-        # self.cos_sim_dict = {'authority': {}, 'fairness': {}, 'general_morality': {}, 'harm': {}, 'ingroup': {},
-        #                      'liberty': {}, 'purity': {}}
+            raise ValueError(f'Invalid mfd value: {mfd}')
+        # multiword entries are joined with underscores, as in the embedding vocabularies and mfd2
+        if words_df['word'].dtype == object:
+            words_df['word'] = words_df['word'].str.strip().str.replace(r'\s+', '_', regex=True)
+        return words_df
 
-    def read_mfd2_into_dataframe(self, current_dir_path):
+    @staticmethod
+    def read_mfd2_into_dataframe(current_dir_path):
         num_to_mf = {}
         mfs_df = []
         with open(f'{current_dir_path}/moral_foundation_dictionaries/mfd2.txt', 'r') as mfd2:
@@ -52,7 +195,6 @@ class FrameAxis:
                     continue
                 if reading_keys:
                     num, mf = line.split()
-                    print(num, mf)
                     num_to_mf[num] = mf
                 else:
                     mf_num = line.split()[-1]
@@ -62,21 +204,48 @@ class FrameAxis:
         mfd2_df = pd.DataFrame(mfs_df)
         return mfd2_df
 
-    def vocab_sim_axes(self, words):
-        # words = self.vocab
-        rows = []
-        for word in words:
-            row_dict = {'token': word}
-            for mf in self.axes.keys():
-                if word in self.vocab:
-                    row_dict[mf] = self.cos_sim(self.model[word], self.axes[mf])
-                else:
-                    row_dict[mf] = np.nan
-            rows.append(row_dict)
-
-        df_sim = pd.DataFrame(rows)
+    def vocab_sim_axes(self, words=None):
+        # defaults to the whole vocabulary, see top_vocab_sim_axes to only keep the most similar words
+        words = list(self.vocab if words is None else words)
+        ids = np.array([self.model.key_to_index.get(word, -1) for word in words], dtype=np.int64)
+        sims = np.full((len(words), len(self.axes)), np.nan)
+        sims[ids >= 0] = self.projections[ids[ids >= 0]]
+        df_sim = pd.DataFrame(sims, columns=list(self.axes.keys()))
+        df_sim.insert(0, 'token', words)
         return df_sim
 
+    def top_vocab_sim_axes(self, k=100, chunk_size=100000):
+        """
+        Scans the projections of the whole model vocabulary chunk by chunk and keeps, for every axis, the k words
+        most similar to its virtue end (top) and to its vice end (bottom). Memory stays bounded by the chunk size.
+        :return: DataFrame with columns axis, end ('top' or 'bottom'), rank, token, and similarity
+        """
+        projections = self.projections
+        n_axes = projections.shape[1]
+        candidate_ids = {'top': [[] for _ in range(n_axes)], 'bottom': [[] for _ in range(n_axes)]}
+        for start in range(0, projections.shape[0], chunk_size):
+            chunk = np.asarray(projections[start:start + chunk_size], dtype=np.float64)
+            for end, sign in (('top', 1.0), ('bottom', -1.0)):
+                # words without a direction (zero vectors) have NaN similarities and are never kept
+                scores = np.nan_to_num(sign * chunk, nan=-np.inf)
+                kth = min(k, scores.shape[0]) - 1
+                best = np.argpartition(-scores, kth, axis=0)[:kth + 1]
+                for axis_idx in range(n_axes):
+                    candidate_ids[end][axis_idx].append(start + best[:, axis_idx])
+
+        rows = []
+        for end, sign in (('top', 1.0), ('bottom', -1.0)):
+            for axis_idx, mf in enumerate(self.axes.keys()):
+                ids = np.sort(np.concatenate(candidate_ids[end][axis_idx] or [np.empty(0, dtype=np.int64)]))
+                sims = np.asarray(projections[ids, axis_idx], dtype=np.float64)
+                keep = ~np.isnan(sims)
+                ids, sims = ids[keep], sims[keep]
+                order = np.lexsort((ids, -sign * sims))[:k]
+                for rank, i in enumerate(order):
+                    rows.append({'axis': mf, 'end': end, 'rank': rank, 'token': self.model.index_to_key[ids[i]],
+                                 'similarity': sims[i]})
+        return pd.DataFrame(rows, columns=['axis', 'end', 'rank', 'token', 'similarity'])
+
     def cos_sim(self, a, b):
         dot = np.dot(a, b)
         norma = np.linalg.norm(a)
@@ -84,244 +253,926 @@ class FrameAxis:
         cos = dot / (norma * normb)
         return cos
 
+    def _lookup(self, words):
+        """
+        :return: model indices of the words found in the embedding model, in order, and the list of the others
+        """
+        words = list(words)
+        ids = np.fromiter((self.model.key_to_index.get(w, -1) for w in words), dtype=np.int64, count=len(words))
+        return ids[ids >= 0], [w for w, i in zip(words, ids) if i < 0]
+
+    def _centroid(self, ids):
+        # rows are averaged in dictionary order, in the vectors' own dtype
+        return np.mean(self.model.vectors[ids], axis=0)
+
     def _compute_axes(self, mfd):
+        """
+        :return: dict of the axis (mean virtue vector - mean vice vector) of every category, in sorted order,
+            and dict of the words of every category missing from the embedding model
+        """
         axes = {}
-        mfs = []
-        grp = mfd.groupby('category')
-        for mf, mf_group in grp:
-            virtue_vecs = []
-            vice_vecs = []
-            print(mf)
-            mfs.append(mf)
-            for w in mf_group.loc[mf_group['sentiment'] == 'virtue', 'word']:
-                try:
-                    virtue_vecs.append(self.model[w])
-                except KeyError:
-                    print(f'{w} not recognized in word embedding model')
-            for w in mf_group.loc[mf_group['sentiment'] == 'vice', 'word']:
-                try:
-                    vice_vecs.append(self.model[w])
-                except KeyError:
-                    print(f'{w} not recognized in word embedding model')
-
-            print('number of virtues: ', len(virtue_vecs))
-            print('number of vices: ', len(vice_vecs))
-            mf_axis = np.mean(np.array(virtue_vecs), axis=0) - np.mean(np.array(vice_vecs), axis=0)
-            print(mf_axis.shape)
-            axes[mf] = mf_axis
-
-        return axes, mfs
+        oov_words = {}
+        # customized.csv spells the sentiments in the plural
+        sentiment = mfd['sentiment'].replace({'virtues': 'virtue', 'vices': 'vice'})
+        for mf, mf_group in mfd.groupby('category'):
+            virtue_ids, virtue_oov = self._lookup(mf_group.loc[sentiment[mf_group.index] == 'virtue', 'word'])
+            vice_ids, vice_oov = self._lookup(mf_group.loc[sentiment[mf_group.index] == 'vice', 'word'])
+            oov_words[mf] = virtue_oov + vice_oov
+            print(f'{mf}: {len(virtue_ids)} virtues, {len(vice_ids)} vices, '
+                  f'{len(oov_words[mf])} words not recognized in word embedding model')
+            axes[mf] = self._centroid(virtue_ids) - self._centroid(vice_ids)
+
+        return axes, oov_words
 
     def _get_emfd_axes(self, eMFD):
+        """
+        Every eMFD word goes to its most probable foundation, on the virtue side if its sentiment there is
+        positive and on the vice side otherwise.
+        :return: dict of the axis of every foundation, dict of the words of every foundation missing from the model
+        """
         print('Building Moral Foundation Axes from eMFD')
-        mfs = set()
+        mfs = []
         mf_p = []
         for col in eMFD.columns:
             if col.endswith('_p'):
-                mfs.add(col.split('_')[0])
+                mfs.append(col.split('_')[0])
                 mf_p.append(col)
 
+        best = eMFD[mf_p].apply(pd.to_numeric).to_numpy().argmax(axis=1)
+        sentiment = eMFD[[f'{mf}_sent' for mf in mfs]].to_numpy()[np.arange(len(eMFD)), best]
+        ids = np.fromiter((self.model.key_to_index.get(w, -1) for w in eMFD['word']), dtype=np.int64,
+                          count=len(eMFD))
+
         axes = {}
-        centroids = {}
-        for index, row in eMFD.iterrows():
-            mf = pd.to_numeric(row[mf_p]).idxmax()
-            mf = mf.split('_')[0]
-            try:
-                vec = self.model[row['word']]
-            except:
-                continue
-            mf_vice = mf + '.vice'
-            mf_virtue = mf + '.virtue'
-            if row[mf + '_sent'] > 0:
-                if mf_virtue not in centroids:
-                    centroids[mf_virtue] = [vec]
-                else:
-                    centroids[mf_virtue].append(vec)
-            else:
-                if mf_vice not in centroids:
-                    centroids[mf_vice] = [vec]
-                else:
-                    centroids[mf_vice].append(vec)
+        oov_words = {}
+        for i, mf in enumerate(mfs):
+            in_mf = best == i
+            oov_words[mf] = eMFD.loc[in_mf & (ids < 0), 'word'].tolist()
+            virtue = self._centroid(ids[in_mf & (ids >= 0) & (sentiment > 0)])
+            vice = self._centroid(ids[in_mf & (ids >= 0) & ~(sentiment > 0)])
+            axes[mf] = virtue - vice
+        print(f'{sum(len(oov) for oov in oov_words.values())} eMFD words not recognized in word embedding model')
 
-        for mf in mfs:
-            mf_vice = mf + '.vice'
-            mf_virtue = mf + '.virtue'
-            centroids[mf_virtue] = np.mean(np.array(centroids[mf_virtue]), axis=0)
-            centroids[mf_vice] = np.mean(np.array(centroids[mf_vice]), axis=0)
-            axes[mf] = centroids[mf_virtue] - centroids[mf_vice]
+        return axes, oov_words
 
-        return axes, mfs
+    def token_ids(self, doc_tokens):
+        """
+        :param doc_tokens: tokens of a document, or their model ids as returned by encode_docs
+        :return: int64 model ids of the in-vocabulary tokens
+        """
+        if isinstance(doc_tokens, np.ndarray) and doc_tokens.dtype.kind in 'iu':
+            return doc_tokens.astype(np.int64, copy=False)
+        ids = np.fromiter((self.model.key_to_index.get(token, -1) for token in doc_tokens), dtype=np.int64)
+        return ids[ids >= 0]
 
-    def framing_scores(self, doc_tokens, mf, B_T=None):
-        bias_score = 0.0
+    def _weighted_scores(self, token_ids, weights, mf, B_T=None):
+        sims = np.asarray(self.projections[token_ids, self.axis_index[mf]], dtype=np.float64)
+        sum_weights = weights.sum()
+        bias_score = (weights * sims).sum() / sum_weights
         intensity_score = 0.0
-        freq = Counter(doc_tokens)
-        doc_tokens_set = list(set(doc_tokens))
-        sum_freq = 0.0
-        for token in doc_tokens_set:
-            sum_freq += freq[token]
-            bias_score += (freq[token] * self.cos_sim(self.model[token], self.axes[mf]))
-            if B_T is not None:
-                intensity_score += (freq[token] * (self.cos_sim(self.model[token], self.axes[mf]) - B_T) ** 2)
-
-        bias_score /= sum_freq
-        intensity_score /= sum_freq
+        if B_T is not None:
+            intensity_score = (weights * (sims - B_T) ** 2).sum() / sum_weights
         return bias_score, intensity_score
 
+    def framing_scores(self, doc_tokens, mf, B_T=None):
+        token_ids, freq = np.unique(self.token_ids(doc_tokens), return_counts=True)
+        return self._weighted_scores(token_ids, freq.astype(np.float64), mf, B_T)
+
     def get_tfidf(self, doc_idx, token):
-        if token in self.tfidf:
-            return self.tfidf[token].iloc[doc_idx]
+        if token in self.tfidf_vocab:
+            return self.tfidf[doc_idx, self.tfidf_vocab[token]]
         else:
             return 0.0
 
     def get_avg_tfidf(self, token):
-        if token in self.tfidf:
-            return self.avg_tfidf[token]
+        if token in self.tfidf_vocab:
+            return self.avg_tfidf[self.tfidf_vocab[token]]
         else:
             return 0.0
 
+    def tfidf_columns(self, token_ids):
+        """:return: tf-idf feature of each model id, -1 for tokens outside the tf-idf vocabulary"""
+        return np.fromiter((self.tfidf_vocab.get(self.model.index_to_key[i], -1) for i in token_ids),
+                           dtype=np.int64, count=len(token_ids))
+
     def framing_scores_tfidf(self, doc_tokens, mf, B_T=None, doc_idx=None):
-        bias_score = 0.0
-        intensity_score = 0.0
-        doc_tokens_set = list(set(doc_tokens))
-        sum_tfidf = 0.0
-        for token in doc_tokens_set:
-            if B_T:
-                tfidf_doc_token = self.get_tfidf(doc_idx, token)
-            else:
-                tfidf_doc_token = self.get_avg_tfidf(token)
-            sum_tfidf += tfidf_doc_token
-            if token not in self.cos_sim_dict[mf]:
-                self.cos_sim_dict[mf][token] = self.cos_sim(self.model[token], self.axes[mf])
-            bias_score += tfidf_doc_token * self.cos_sim_dict[mf][token]
-            if B_T is not None:
-                intensity_score += tfidf_doc_token * (self.cos_sim_dict[mf][token] - B_T) ** 2
-
-        bias_score /= sum_tfidf
-        intensity_score /= sum_tfidf
-        return bias_score, intensity_score
+        token_ids = np.unique(self.token_ids(doc_tokens))
+        cols = self.tfidf_columns(token_ids)
+        valid = cols >= 0
+        weights = np.zeros(len(token_ids))
+        if B_T:
+            weights[valid] = self.tfidf[doc_idx, cols[valid]].toarray().ravel()
+        else:
+            weights[valid] = self.avg_tfidf[cols[valid]]
+        return self._weighted_scores(token_ids, weights, mf, B_T)
 
     def framing_scores_set(self, doc_tokens, mf, B_T=None):
         # todo what was this for?
-        doc_tokens = list(set(doc_tokens))
-        bias_score = 0.0
-        intensity_score = 0.0
-        freq = Counter(doc_tokens)
-        doc_tokens_set = list(set(doc_tokens))
-        sum_freq = 0.0
-        for token in doc_tokens_set:
-            sum_freq += freq[token]
-            bias_score += (freq[token] * self.cos_sim(self.model[token], self.axes[mf]))
-            if B_T is not None:
-                intensity_score += (freq[token] * (self.cos_sim(self.model[token], self.axes[mf]) - B_T) ** 2)
-
-        bias_score /= sum_freq
-        intensity_score /= sum_freq
-        return bias_score, intensity_score
+        token_ids = np.unique(self.token_ids(doc_tokens))
+        return self._weighted_scores(token_ids, np.ones(len(token_ids)), mf, B_T)
+
+    def calc_tfidf(self, docs, vectorizer=None):
+        """
+        :param vectorizer: an already fitted TfidfVectorizer (see fit_tfidf_stream), by default one is fit on docs
+        :return: sparse CSR (docs x features) tf-idf matrix, the fitted vectorizer
+        """
+        if vectorizer is None:
+            # fit then transform rather than fit_transform, whose rows come out in a different summation order
+            vectorizer = TfidfVectorizer(max_df=.8, min_df=20, sublinear_tf=True).fit(docs)
+        return vectorizer.transform(docs).tocsr(), vectorizer
 
-    def calc_tfidf(self, docs):
+    def fit_tfidf_stream(self, doc_chunks):
+        """
+        Fit the tf-idf of calc_tfidf on a corpus streamed in chunks, without ever holding the whole corpus.
+        :param doc_chunks: callable returning a fresh iterator over Series of preprocessed docs, it is consumed twice
+        :return: the fitted TfidfVectorizer, corpus-average tf-idf of every feature
+        """
         vectorizer = TfidfVectorizer(max_df=.8, min_df=20, sublinear_tf=True)
-        vectors = vectorizer.fit_transform(docs)
-        feature_names = vectorizer.get_feature_names()
-        # dense = vectors.todense()
-        # denselist = dense.tolist()
-        denselist = vectors.toarray()
-        tfidf = pd.DataFrame(denselist, columns=feature_names)
-        return tfidf
-
-    def doc_scores(self, docs, baseline_docs, tfidf=False):
-        if tfidf:
-            self.tfidf = self.calc_tfidf(docs)
-            print('tfidf', self.tfidf.shape)
-            self.avg_tfidf = self.tfidf.mean(axis=0)
-        biases = pd.DataFrame()
-        intensities = pd.DataFrame()
-        docs = docs.str.lower()
-
-        if baseline_docs:
-            all_baseline_docs = ' '.join(baseline_docs)
-            all_docs_tokens = [x for x in all_baseline_docs.split() if x in self.vocab]
-
-        for mf in self.axes.keys():
-            print(mf)
-            mf_scores_bias = []
-            mf_scores_intensity = []
-            if tfidf and baseline_docs:
-                B_T, _ = self.framing_scores_tfidf(doc_tokens=all_docs_tokens, mf=mf)
-            elif baseline_docs:
-                B_T, _ = self.framing_scores(doc_tokens=all_docs_tokens, mf=mf)
+        analyzer = vectorizer.build_analyzer()
+        doc_freq = Counter()
+        n_docs = 0
+        for docs in doc_chunks():
+            n_docs += len(docs)
+            for doc in docs:
+                doc_freq.update(set(analyzer(doc)))
+        # same pruning and smoothed idf as TfidfVectorizer.fit
+        terms = sorted(term for term, freq in doc_freq.items()
+                       if vectorizer.min_df <= freq <= vectorizer.max_df * n_docs)
+        if not terms:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+        vectorizer.vocabulary = {term: i for i, term in enumerate(terms)}
+        vectorizer.idf_ = np.log((1 + n_docs) / (1 + np.array([doc_freq[term] for term in terms]))) + 1
+
+        high, low = np.zeros(len(terms), dtype=np.int64), np.zeros(len(terms), dtype=np.int64)
+        for docs in doc_chunks():
+            chunk_high, chunk_low = self.tfidf_column_sums(vectorizer.transform(docs))
+            high += chunk_high
+            low += chunk_low
+        return vectorizer, self.fixed_point_mean(high, low, n_docs)
+
+    @staticmethod
+    def tfidf_column_sums(tfidf):
+        """
+        Column sums of a tf-idf matrix in 2 x 40 bit fixed point. Integer addition is exact and order independent,
+        so the average tf-idf is bit for bit the same whether the corpus is summed at once or chunk by chunk.
+        :return: int64 arrays of the high and low parts of the sums, in units of 2**-40 and 2**-80
+        """
+        scaled = np.ldexp(tfidf.data, 40)
+        high = np.floor(scaled)
+        low = np.rint(np.ldexp(scaled - high, 40))
+        high_sums, low_sums = np.zeros(tfidf.shape[1], dtype=np.int64), np.zeros(tfidf.shape[1], dtype=np.int64)
+        np.add.at(high_sums, tfidf.indices, high.astype(np.int64))
+        np.add.at(low_sums, tfidf.indices, low.astype(np.int64))
+        return high_sums, low_sums
+
+    @staticmethod
+    def fixed_point_mean(high, low, n):
+        high = high + (low >> 40)
+        low = low & (2 ** 40 - 1)
+        return (np.ldexp(high.astype(np.float64), -40) + np.ldexp(low.astype(np.float64), -80)) / n
+
+    def axes_matrix(self):
+        """Stack the axes into an (axes x dim) matrix of unit vectors, in the order of self.axes."""
+        axes = np.array([self.axes[mf] for mf in self.axes.keys()], dtype=np.float64)
+        return axes / np.linalg.norm(axes, axis=1, keepdims=True)
+
+    def project_vectors(self, vectors):
+        """Cosine similarity of every row of vectors with every axis, shape (rows x axes)."""
+        vecs = np.asarray(vectors, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vecs = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs @ self.axes_matrix().T
+
+    def encode_docs(self, docs):
+        """
+        Tokenize docs on whitespace once, interning each token as its model id and dropping the tokens outside the
+        embedding vocabulary.
+        :param docs: pandas Series of preprocessed documents
+        :return: int64 model ids of all the tokens of all the docs, in order, and the position in docs of each token
+        """
+        splits = docs.str.split()
+        lengths = splits.str.len().fillna(0).to_numpy(dtype=np.int64)
+        doc_idx = np.repeat(np.arange(len(docs)), lengths)
+        codes, uniques = pd.factorize(np.fromiter(chain.from_iterable(splits.dropna()), dtype=object,
+                                                  count=lengths.sum()))
+        model_ids = np.fromiter((self.model.key_to_index.get(token, -1) for token in uniques), dtype=np.int64,
+                                count=len(uniques))
+        token_ids = model_ids[codes]
+        keep = token_ids >= 0
+        return token_ids[keep], doc_idx[keep]
+
+    def count_matrix(self, docs):
+        """
+        :param docs: pandas Series of preprocessed documents
+        :return: sparse (docs x tokens) count matrix, model indices of the tokens indexing its columns
+        """
+        token_ids, doc_idx = self.encode_docs(docs)
+        return self._count_matrix(token_ids, doc_idx, len(docs))
+
+    @staticmethod
+    def _count_matrix(token_ids, doc_idx, n_docs):
+        # columns follow the model order, so that the summation order (and so the scores, to the last bit)
+        # of a document does not depend on the other documents it is scored with
+        present = np.bincount(token_ids, minlength=1) > 0
+        vocab_ids = np.flatnonzero(present)
+        col_ids = (np.cumsum(present) - 1)[token_ids]
+        counts = sparse.csr_matrix((np.ones(len(token_ids)), (doc_idx, col_ids)), shape=(n_docs, len(vocab_ids)))
+        counts.sort_indices()
+        return counts, vocab_ids
+
+    def bincount_scores(self, token_ids, doc_idx, n_docs, B_T):
+        """
+        Bias and intensity of every document on every axis, summing the gathered projections of the encoded tokens
+        per document with np.bincount. Documents without tokens get NaN scores.
+        :param token_ids, doc_idx: encoded documents, see encode_docs
+        """
+        doc_len = np.bincount(doc_idx, minlength=n_docs).astype(np.float64)
+        doc_len[doc_len == 0] = np.nan
+        bias = np.empty((n_docs, len(self.axes)))
+        intensity = np.empty((n_docs, len(self.axes)))
+        for i in range(len(self.axes)):
+            sims = np.asarray(self.projections[token_ids, i], dtype=np.float64)
+            bias[:, i] = np.bincount(doc_idx, weights=sims, minlength=n_docs) / doc_len
+            intensity[:, i] = np.bincount(doc_idx, weights=(sims - B_T[i]) ** 2, minlength=n_docs) / doc_len
+        return bias, intensity
+
+    def matrix_scores(self, counts, projections, B_T):
+        """
+        Bias and intensity of every document on every axis with sparse matrix products.
+        :param counts: sparse (docs x tokens) count (or weight) matrix
+        :param projections: (tokens x axes) cosine similarities of the tokens with the axes
+        :param B_T: array of per-axis baseline biases
+        :return: (docs x axes) arrays of bias and intensity scores, NaN for documents without tokens
+        """
+        doc_len = np.asarray(counts.sum(axis=1)).ravel()[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bias = (counts @ projections) / doc_len
+            intensity = (counts @ (projections - B_T) ** 2) / doc_len
+        bias[doc_len[:, 0] == 0] = np.nan
+        intensity[doc_len[:, 0] == 0] = np.nan
+        return bias, intensity
+
+    def tfidf_weights(self, counts, token_ids, per_doc=False):
+        """
+        Replace the counts of a count_matrix with tf-idf weights of each unique token of the documents, as
+        framing_scores_tfidf does: the per-document tf-idf when per_doc, else the corpus-average tf-idf of the token.
+        Tokens outside the tf-idf vocabulary get a zero weight.
+        """
+        cols = self.tfidf_columns(token_ids)
+        valid = cols >= 0
+        presence = counts.copy()
+        presence.data[:] = 1.0
+        if per_doc:
+            # (features x tokens) selection matrix moving the tf-idf columns onto the count_matrix columns
+            select = sparse.csr_matrix((np.ones(valid.sum()), (cols[valid], np.flatnonzero(valid))),
+                                       shape=(self.tfidf.shape[1], len(token_ids)))
+            return presence.multiply(self.tfidf @ select).tocsr()
+        return (presence @ sparse.diags(np.where(valid, self.avg_tfidf[cols], 0.0))).tocsr()
+
+    def top_tokens(self, weights, token_ids, bias, k):
+        """
+        The k tokens of every document contributing the most to its bias on every axis, in the direction of the bias
+        (the most negative contributions for a negative bias). The contribution of a token is its weight times its
+        similarity with the axis over the total weight of the doc, so the contributions of a doc add up to its bias.
+        :param weights: sparse (docs x tokens) count or tf-idf matrix the docs were scored with
+        :param token_ids: model indices of the tokens indexing the columns of weights
+        :param bias: (docs x axes) bias scores of the docs
+        :return: dict of axis -> list of 'token:contribution ...' strings, one per doc
+        """
+        # tokens outside the tf-idf vocabulary have a zero weight, they contribute nothing
+        weights = weights.tocsr(copy=True)
+        weights.eliminate_zeros()
+        doc_sizes = np.diff(weights.indptr)
+        rows = np.repeat(np.arange(weights.shape[0]), doc_sizes)
+        doc_weight = np.asarray(weights.sum(axis=1)).ravel()
+        tokens = np.array([self.model.index_to_key[i] for i in token_ids], dtype=object)[weights.indices]
+        starts = weights.indptr[:-1][doc_sizes > 0]
+        top = {}
+        for i, mf in enumerate(self.axes.keys()):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                contribution = weights.data * np.asarray(self.projections[token_ids[weights.indices], i],
+                                                         dtype=np.float64) / doc_weight[rows]
+            key = np.nan_to_num(np.where(bias[rows, i] < 0, -contribution, contribution), nan=-np.inf)
+            # partial sort: k rounds picking the best remaining token of every doc, ties go to the model order
+            picked = []
+            for _ in range(min(k, doc_sizes.max(initial=0))):
+                best = np.repeat(np.maximum.reduceat(key, starts), doc_sizes[doc_sizes > 0]) if len(starts) else key
+                hits = np.flatnonzero((key == best) & (key > -np.inf))
+                hits = hits[np.r_[True, rows[hits[1:]] != rows[hits[:-1]]]] if len(hits) else hits
+                picked.append(hits)
+                key[hits] = -np.inf
+            picked = np.concatenate(picked) if picked else np.empty(0, dtype=np.int64)
+            # the rounds yield each doc's tokens in decreasing order, a stable sort groups them by doc
+            picked = picked[np.argsort(rows[picked], kind='stable')]
+            entries = iter(['%s:%.4g' % entry for entry in zip(tokens[picked], contribution[picked].tolist())])
+            top[mf] = [' '.join(islice(entries, n)) for n in np.bincount(rows[picked], minlength=weights.shape[0])]
+        return top
+
+    def score_docs(self, docs, B_T, tfidf=False, per_doc_tfidf=False, top_k=0):
+        """
+        :param docs: Series of preprocessed docs, in tfidf mode self.tfidf must hold their tf-idf rows
+        :param top_k: also return the top_k contributing tokens of every doc on every axis, see top_tokens
+        :return: (docs x axes) arrays of bias and intensity scores, and the top tokens when top_k
+        """
+        if not tfidf:
+            token_ids, doc_idx = self.encode_docs(docs.str.lower())
+            print(f'Scoring {len(docs)} docs over {len(token_ids)} tokens')
+            self.metrics.count('tokens', len(token_ids))
+            bias, intensity = self.bincount_scores(token_ids, doc_idx, len(docs), B_T)
+            if not top_k:
+                return bias, intensity
+            counts, token_ids = self._count_matrix(token_ids, doc_idx, len(docs))
+            return bias, intensity, self.top_tokens(counts, token_ids, bias, top_k)
+        counts, token_ids = self.count_matrix(docs.str.lower())
+        print(f'Scoring {counts.shape[0]} docs over {counts.shape[1]} unique tokens')
+        self.metrics.count('tokens', counts.sum())
+        counts = self.tfidf_weights(counts, token_ids, per_doc=per_doc_tfidf)
+        bias, intensity = self.matrix_scores(counts, np.asarray(self.projections[token_ids], dtype=np.float64), B_T)
+        if not top_k:
+            return bias, intensity
+        return bias, intensity, self.top_tokens(counts, token_ids, bias, top_k)
+
+    def fit_tfidf(self, docs, tfidf_vectorizer=None, avg_tfidf=None):
+        self.tfidf, self.tfidf_vectorizer = self.calc_tfidf(docs, tfidf_vectorizer)
+        self.tfidf_vocab = self.tfidf_vectorizer.vocabulary_
+        print('tfidf', self.tfidf.shape)
+        if avg_tfidf is None:
+            avg_tfidf = self.fixed_point_mean(*self.tfidf_column_sums(self.tfidf), self.tfidf.shape[0])
+        self.avg_tfidf = avg_tfidf
+
+    @staticmethod
+    def sample_mask(docs, frac, seed=157):
+        """
+        Reproducible sample of docs for the baseline. Each doc is kept or not from a seeded hash of its text, so
+        the sample does not depend on the row order or on how the corpus is chunked.
+        :return: boolean mask over docs, all True when frac is 1
+        """
+        hashes = pd.util.hash_pandas_object(docs, index=False, hash_key=f'{seed:016d}'[-16:]).to_numpy()
+        return np.ldexp(hashes.astype(np.float64), -64) < frac
+
+    def baseline_counts(self, docs, counts=None):
+        """
+        Aggregated token counts of the baseline corpus, one per word of the model. Call it chunk by chunk
+        passing the previous counts so that the corpus is never held or joined at once.
+        :param docs: Series of preprocessed docs
+        :return: int64 counts indexed by model id
+        """
+        token_ids, _ = self.encode_docs(docs.str.lower())
+        chunk_counts = np.bincount(token_ids, minlength=len(self.model.index_to_key))
+        return chunk_counts if counts is None else counts + chunk_counts
+
+    @staticmethod
+    def has_baseline(baseline_docs):
+        return baseline_docs is not None and len(baseline_docs) > 0
+
+    def baseline_bias(self, baseline_docs, tfidf=False):
+        """
+        Corpus-level bias B_T of every axis: the frequency (or average tf-idf) weighted mean similarity of the
+        baseline tokens.
+        :param baseline_docs: preprocessed baseline docs, or their aggregated baseline_counts
+        """
+        B_T = np.zeros(len(self.axes))
+        if self.has_baseline(baseline_docs):
+            counts = baseline_docs if isinstance(baseline_docs, np.ndarray) \
+                else self.baseline_counts(pd.Series(list(baseline_docs), dtype=object))
+            token_ids = np.flatnonzero(counts)
+            if tfidf:
+                # each baseline token is weighted once by its average tf-idf, as in framing_scores_tfidf
+                cols = self.tfidf_columns(token_ids)
+                weights = np.where(cols >= 0, self.avg_tfidf[cols], 0.0)
             else:
-                B_T = 0.0
-            print('B_T = {}'.format(B_T))
-            for idx in range(len(docs)):
-                if idx % 100000 == 0:
-                    print(f'Current doc_idx: {idx}/ Total: {len(docs)}')
-                doc = docs[idx]
-                doc_tokens = [x for x in doc.split() if x in self.vocab]
-                if len(doc_tokens) == 0:
-                    score_bias, score_intensity = (np.nan, np.nan)
-                # print('nan doc:', doc)
-                else:
-                    if tfidf:
-                        score_bias, score_intensity = self.framing_scores_tfidf(doc_tokens, mf, B_T, idx)
-                    else:
-                        score_bias, score_intensity = self.framing_scores(doc_tokens, mf, B_T)
-                mf_scores_bias.append(score_bias)
-                mf_scores_intensity.append(score_intensity)
-            biases['bias_{}'.format(mf)] = mf_scores_bias
-            intensities['intensity_{}'.format(mf)] = mf_scores_intensity
-        return biases, intensities
+                weights = counts[token_ids].astype(np.float64)
+            if weights.sum() > 0:
+                B_T = weights @ np.asarray(self.projections[token_ids], dtype=np.float64) / weights.sum()
+            else:
+                print('No baseline token is in the vocabulary, using B_T = 0')
+        print('B_T = {}'.format(dict(zip(self.axes.keys(), B_T))))
+        return B_T
+
+    def _scores_frames(self, bias, intensity, top=None):
+        biases = pd.DataFrame(bias, columns=['bias_{}'.format(mf) for mf in self.axes.keys()])
+        intensities = pd.DataFrame(intensity, columns=['intensity_{}'.format(mf) for mf in self.axes.keys()])
+        if top is None:
+            return biases, intensities
+        return biases, intensities, pd.DataFrame({f'top_tokens_{mf}': top[mf] for mf in self.axes.keys()})
+
+    def doc_scores(self, docs, baseline_docs, tfidf=False, tfidf_vectorizer=None, avg_tfidf=None, top_k=0):
+        """:param top_k: also return a frame of the top_k contributing tokens of every doc, see top_tokens"""
+        if tfidf:
+            self.fit_tfidf(docs, tfidf_vectorizer, avg_tfidf)
+        B_T = self.baseline_bias(baseline_docs, tfidf)
+        return self._scores_frames(*self.score_docs(docs, B_T, tfidf, per_doc_tfidf=self.has_baseline(baseline_docs),
+                                                    top_k=top_k))
+
+    @contextmanager
+    def worker_pool(self, n_jobs):
+        """
+        Process pool whose workers score with this FrameAxis. They attach to the projection table through the
+        projection cache file (memory-mapped) or a shared memory block instead of receiving a copy of the model.
+        """
+        projections = self.projections
+        shm = None
+        if isinstance(projections, np.memmap):
+            source = ('mmap', projections.filename)
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=max(projections.nbytes, 1))
+            np.ndarray(projections.shape, dtype=projections.dtype, buffer=shm.buf)[:] = projections
+            source = ('shm', shm.name, projections.shape, projections.dtype.str)
+        vocab = SimpleNamespace(key_to_index=self.model.key_to_index, index_to_key=self.model.index_to_key)
+        try:
+            with Pool(n_jobs, initializer=_init_scoring_worker,
+                      initargs=(self.mfd, self.axes, vocab, source, self.phrases)) as pool:
+                yield pool
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def parallel_doc_scores(self, raw_docs, baseline_docs, tfidf=False, n_jobs=2, tfidf_vectorizer=None,
+                            avg_tfidf=None, batch_size=10000, baseline_raw_docs=None, top_k=0):
+        """
+        doc_scores over a pool of n_jobs processes, each preprocessing and scoring batches of batch_size raw docs.
+        Batches are reassembled in input order, and scores are the same as doc_scores on the preprocessed docs.
+        :param baseline_raw_docs: raw docs to preprocess and count in the pool as the baseline, instead of
+            baseline_docs
+        """
+        raw_docs = raw_docs.reset_index(drop=True)
+        batches = [raw_docs[start:start + batch_size] for start in range(0, len(raw_docs), batch_size)]
+        with self.worker_pool(n_jobs) as pool:
+            if baseline_raw_docs is not None:
+                baseline_docs = np.zeros(len(self.model.index_to_key), dtype=np.int64)
+                for token_ids, counts in pool.map(_count_batch, [baseline_raw_docs[start:start + batch_size] for
+                                                                 start in range(0, len(baseline_raw_docs),
+                                                                                batch_size)]):
+                    baseline_docs[token_ids] += counts
+            tfidf_state = None
+            if tfidf:
+                # the tf-idf is fit on the whole corpus, so the docs come back to be fit before being scored
+                batches = pool.map(partial(preprocess, phrases=self.phrases), batches)
+                self.fit_tfidf(pd.concat(batches, ignore_index=True), tfidf_vectorizer, avg_tfidf)
+                tfidf_state = (self.tfidf_vectorizer, self.avg_tfidf)
+            B_T = self.baseline_bias(baseline_docs, tfidf)
+            results = pool.map(_score_batch, [(batch, tfidf, B_T, self.has_baseline(baseline_docs), tfidf_state,
+                                               top_k) for batch in batches])
+        if not results:
+            empty = np.empty((0, len(self.axes)))
+            return self._scores_frames(empty, empty, {mf: [] for mf in self.axes} if top_k else None)
+        top = None
+        if top_k:
+            top = {mf: [doc_top for result in results for doc_top in result[2][mf]] for mf in self.axes}
+        return self._scores_frames(np.concatenate([result[0] for result in results]),
+                                   np.concatenate([result[1] for result in results]), top)
+
+    def virtue_vice_scores(self, fa_scores):
+        """
+        Splits each foundation's intensity into {mf}.virtue and {mf}.vice columns: the intensity goes to the side
+        of the axis the bias falls on (vice for negative biases) and the other side is 0.
+        :param fa_scores: frame holding the bias_{mf} and intensity_{mf} columns
+        :return: frame of only the virtue/vice columns, on the index of fa_scores
+        """
+        mfs = list(self.axes.keys())
+        bias = fa_scores[[f'bias_{mf}' for mf in mfs]].to_numpy(dtype=np.float64)
+        intensity = fa_scores[[f'intensity_{mf}' for mf in mfs]].to_numpy(dtype=np.float64)
+        virtue_vice = np.empty((bias.shape[0], 2 * len(mfs)))
+        virtue_vice[:, 0::2] = np.where(bias < 0, 0.0, intensity)
+        virtue_vice[:, 1::2] = np.where(bias < 0, intensity, 0.0)
+        # docs left unscored by some of the dictionaries, see get_fa_scores
+        virtue_vice[np.repeat(np.isnan(bias), 2, axis=1)] = np.nan
+        # fixed column order and dtype, so that chunks appended by get_fa_scores_stream line up
+        return pd.DataFrame(virtue_vice, index=fa_scores.index,
+                            columns=[f'{mf}.{sentiment}' for mf in mfs for sentiment in ('virtue', 'vice')])
 
     def get_fa_scores(self, df, doc_colname, save_path=None, tfidf=False,
-                      format="virtue_vice"):
+                      format="virtue_vice", tfidf_vectorizer=None, avg_tfidf=None, n_jobs=1,
+                      baseline_frac=None, baseline_seed=157, baseline_counts=None, incremental=False,
+                      key_col=None, done_keys=None, output_format="csv", partition_cols=None, scores_only=False,
+                      top_k=0):
+        """
+        :param baseline_frac: fraction of the docs sampled (see sample_mask) as the baseline corpus, intensities
+            are then relative to its bias B_T. None scores without a baseline
+        :param baseline_counts: already aggregated baseline_counts, e.g. of the whole corpus when scoring it chunk
+            by chunk, used instead of sampling df. With several groups of dictionaries (see groups), this and
+            tfidf_vectorizer and avg_tfidf are lists with one per group
+        :param incremental: skip the docs already scored into save_path, so that re-runs only score new docs and
+            never duplicate rows. Unless tfidf_vectorizer is given, the tf-idf is still fit on all the docs of df,
+            so the new docs are weighted as in a run over the whole of df.
+        :param key_col: column identifying the docs (e.g. the post id), by default a hash of the whole row (as
+            drop_duplicates tells the rows apart) saved in a doc_hash column
+        :param done_keys: keys already scored, see load_done_keys, read from save_path when None
+        :param output_format: "csv", or "parquet" to write save_path as a parquet dataset directory, see save_scores
+        :param partition_cols: columns to partition the parquet dataset by, e.g. ["subreddit"]
+        :param scores_only: only keep the key, partition and score columns, dropping the doc text and the rest of df
+        :param top_k: add top_tokens_{mf} columns listing the top_k tokens contributing to the bias of every doc
+        """
         df = df.reset_index(drop=True)
         docs = df[doc_colname]
-        print(f'Preprocessing column {doc_colname}')
-        docs = preprocess(docs).reset_index(drop=True)
-        baseline_docs = []  # todo docs.sample(frac=0.3, random_state=157).reset_index(drop=True)
+        self.metrics.count('docs_in', df.shape[0])
+        baseline_docs = baseline_counts
+        baseline_mask = None
+        if baseline_counts is None and baseline_frac:
+            baseline_mask = self.sample_mask(docs, baseline_frac, baseline_seed)
+            print(f'Sampled {baseline_mask.sum()} baseline docs')
+
+        keys = None
+        baseline_raw_docs = None
+        if incremental and save_path:
+            input_columns = df.columns.tolist()
+            if key_col is None:
+                df['doc_hash'] = self.key_values(df).to_numpy()
+            keys = self.doc_keys(df, key_col)
+            if done_keys is None:
+                done_keys = self.load_done_keys(save_path, key_col or 'doc_hash', input_columns)
+            new = ~np.isin(keys, done_keys) & ~pd.Series(keys).duplicated().to_numpy()
+            print(f'{df.shape[0] - new.sum()} docs already scored in {save_path}, scoring the {new.sum()} others')
+            self.metrics.count('docs_skipped', df.shape[0] - new.sum())
+            if baseline_mask is not None and not new.all():
+                # the baseline still covers the whole corpus, not only the new docs
+                baseline_raw_docs = docs[baseline_mask]
+                baseline_mask = None
+            if tfidf and tfidf_vectorizer is None and new.any() and not new.all():
+                tfidf_vectorizer, avg_tfidf = self.fit_tfidf_groups(docs[~pd.Series(keys).duplicated().to_numpy()],
+                                                                    n_jobs)
+            df, keys = df[new].reset_index(drop=True), keys[new]
+            docs = df[doc_colname]
+            if df.shape[0] == 0:
+                return df
         # todo build the w2v model
-        print('Let\'s calculate bias and intensity')
-        bias, intensity = self.doc_scores(docs=docs, baseline_docs=baseline_docs, tfidf=tfidf)
+        score_args = (docs, doc_colname, baseline_docs, baseline_mask, baseline_raw_docs, tfidf, tfidf_vectorizer,
+                      avg_tfidf, n_jobs, top_k)
+        frames = self._group_frames(*score_args) if self.groups else self._score_frames(*score_args)
+        bias, intensity = frames[:2]
         print('total size: ', df.shape[0])
         print('any NaN in bias?', np.isnan(bias.values).sum())  # Nan means empty docs, we should remove them
         print('any NaN in intensity?', np.isnan(intensity.values).sum())
 
-        fa_scores = pd.concat([df, bias, intensity], axis=1)
+        fa_scores = pd.concat([df, *frames], axis=1)
 
-        fa_scores = fa_scores.dropna(subset=bias.columns.tolist() + intensity.columns.tolist()).reset_index(
+        # the docs without any token scored are dropped. With several groups of dictionaries a doc may only be
+        # empty for some of them (e.g. after the tf-idf weighting), it is then kept with NaN scores for those
+        fa_scores = fa_scores.dropna(subset=bias.columns.tolist() + intensity.columns.tolist(), how='all').reset_index(
             drop=True)
         print('NAN scores dropped, new size:', fa_scores.shape[0])
+        self.metrics.count('docs_scored', fa_scores.shape[0])
+        self.metrics.count('docs_empty', df.shape[0] - fa_scores.shape[0])
 
-        if format == "virtue_vice":
-            df_virtue_vice = []
-            for index, row in fa_scores.iterrows():
-                row_virtue_vice = {}
-                for mf in self.axes.keys():
-                    if row[f'bias_{mf}'] < 0:
-                        row_virtue_vice[f'{mf}.vice'] = row[
-                            f'intensity_{mf}']
-                        row_virtue_vice[f'{mf}.virtue'] = 0
-                    else:
-                        row_virtue_vice[f'{mf}.virtue'] = row[f'intensity_{mf}']
-                        row_virtue_vice[f'{mf}.vice'] = 0
-                df_virtue_vice.append(row_virtue_vice)
-
-            df_virtue_vice = pd.DataFrame(df_virtue_vice)
-            fa_scores = pd.concat([fa_scores, df_virtue_vice], axis=1)
+        if format in ("virtue_vice", "virtue_vice_only"):
+            with self.metrics.stage('format'):
+                # added in place rather than concatenated, so the full frame is not copied once more
+                df_virtue_vice = self.virtue_vice_scores(fa_scores)
+                fa_scores[df_virtue_vice.columns.tolist()] = df_virtue_vice.to_numpy()
+                if format == "virtue_vice_only":
+                    fa_scores.drop(columns=bias.columns.tolist() + intensity.columns.tolist(), inplace=True)
             print('After addding vice-virtue scores, the shape:', fa_scores.shape)
 
+        score_cols = fa_scores.columns[df.shape[1]:].tolist()
+        if scores_only:
+            if key_col is None and 'doc_hash' not in fa_scores.columns:
+                fa_scores.insert(0, 'doc_hash', self.key_values(fa_scores, columns=df.columns).to_numpy())
+            key_cols = [key_col or 'doc_hash'] + [col for col in partition_cols or [] if col != key_col]
+            fa_scores = fa_scores[key_cols + score_cols]
+
         if save_path:
             if len(save_path.split('/')) > 1:
                 output_dir = '/'.join(save_path.split('/')[:-1])
                 Path(output_dir).mkdir(parents=True, exist_ok=True)
-            
-            if os.path.isfile(save_path):
-                # fa_scores.drop(columns=[doc_colname], inplace=True)
-                fa_scores.to_csv(save_path, mode="a", index=False, header=None)
-            else:
-                fa_scores.to_csv(save_path, index=False)
+
+            with self.metrics.stage('save'):
+                if output_format == "parquet":
+                    self.save_scores_parquet(fa_scores, save_path, score_cols, partition_cols)
+                elif os.path.isfile(save_path):
+                    # fa_scores.drop(columns=[doc_colname], inplace=True)
+                    self.match_csv_header(fa_scores, save_path).to_csv(save_path, mode="a", index=False,
+                                                                       header=None)
+                else:
+                    fa_scores.to_csv(save_path, index=False)
 
             print('Moral Foundations FrameAxis scores saved to {}'.format(save_path))
+            if keys is not None:
+                # after the scores, so that a crash in between is recovered from the keys of save_path
+                self.checkpoint_keys(save_path, keys)
+            # rewritten after every chunk of a stream, so long runs can be followed while they go
+            self.metrics.write(save_path)
         else:
             print('not saving the fa scores.')
-        return fa_scores
\ No newline at end of file
+        return fa_scores
+
+    def fit_tfidf_groups(self, docs, n_jobs=1):
+        """
+        Fits the tf-idf on the raw docs, on the tokens of every group of dictionaries (see groups).
+        :return: the fitted tfidf_vectorizer and avg_tfidf, lists with one per group when there are groups
+        """
+        print('Fitting tfidf over all the docs')
+        fits = []
+        with self.metrics.stage('tfidf'):
+            for fa in [fa for fa, _ in self.groups] or [self]:
+                fa.fit_tfidf(preprocess(docs, n_jobs, phrases=fa.phrases).reset_index(drop=True))
+                fits.append((fa.tfidf_vectorizer, fa.avg_tfidf))
+        if not self.groups:
+            return fits[0]
+        return [fit[0] for fit in fits], [fit[1] for fit in fits]
+
+    def _score_frames(self, docs, doc_colname, baseline_docs, baseline_mask, baseline_raw_docs, tfidf,
+                      tfidf_vectorizer, avg_tfidf, n_jobs, top_k):
+        """
+        Preprocesses and scores the raw docs for get_fa_scores.
+        :param baseline_docs: baseline counts, or None to count the docs[baseline_mask] or else baseline_raw_docs
+        :return: the bias and intensity frames (and top tokens frame with top_k), see doc_scores
+        """
+        if n_jobs > 1:
+            print(f'Let\'s preprocess column {doc_colname} and calculate bias and intensity with {n_jobs} processes')
+            # the workers preprocess their batches, so the score stage includes the preprocessing
+            with self.metrics.stage('score'):
+                frames = self.parallel_doc_scores(
+                    raw_docs=docs, baseline_docs=baseline_docs, tfidf=tfidf, n_jobs=n_jobs,
+                    tfidf_vectorizer=tfidf_vectorizer, avg_tfidf=avg_tfidf,
+                    baseline_raw_docs=docs[baseline_mask] if baseline_mask is not None else baseline_raw_docs,
+                    top_k=top_k)
+        else:
+            print(f'Preprocessing column {doc_colname}')
+            with self.metrics.stage('preprocess'):
+                docs = self.preprocess(docs).reset_index(drop=True)
+            if baseline_mask is not None:
+                with self.metrics.stage('baseline'):
+                    baseline_docs = self.baseline_counts(docs[baseline_mask])
+            elif baseline_raw_docs is not None:
+                with self.metrics.stage('baseline'):
+                    baseline_docs = self.baseline_counts(self.preprocess(baseline_raw_docs))
+            print('Let\'s calculate bias and intensity')
+            with self.metrics.stage('score'):
+                frames = self.doc_scores(docs=docs, baseline_docs=baseline_docs, tfidf=tfidf,
+                                         tfidf_vectorizer=tfidf_vectorizer, avg_tfidf=avg_tfidf, top_k=top_k)
+        return frames
+
+    def _group_frames(self, docs, doc_colname, baseline_docs, baseline_mask, baseline_raw_docs, tfidf,
+                      tfidf_vectorizer, avg_tfidf, n_jobs, top_k):
+        """
+        _score_frames of every group of dictionaries (see groups), each on the docs preprocessed with its own
+        multiword entries, put back together in the order of the axes.
+        :param baseline_docs, tfidf_vectorizer, avg_tfidf: a list with one per group, or None
+        """
+        group_frames = []
+        for i, (fa, names) in enumerate(self.groups):
+            frames = fa._score_frames(docs, doc_colname, baseline_docs[i] if baseline_docs is not None else None,
+                                      baseline_mask, baseline_raw_docs, tfidf,
+                                      tfidf_vectorizer[i] if tfidf_vectorizer is not None else None,
+                                      avg_tfidf[i] if avg_tfidf is not None else None, n_jobs, top_k)
+            group_frames.append([frame.rename(columns={f'{prefix}{name}': f'{prefix}{full_name}'
+                                                       for name, full_name in names.items()})
+                                 for prefix, frame in zip(FRAME_PREFIXES, frames)])
+        return tuple(pd.concat([frames[k] for frames in group_frames], axis=1)[[f'{prefix}{mf}' for mf in self.axes]]
+                     for k, prefix in enumerate(FRAME_PREFIXES[:len(group_frames[0])]))
+
+    @staticmethod
+    def save_scores_parquet(fa_scores, save_path, score_cols, partition_cols=None):
+        """
+        Adds fa_scores to the parquet dataset directory save_path as new files, with float32 score columns and
+        hive-style partitions (save_path/subreddit=.../part-*.parquet), so each chunk is written without rewriting
+        the previous ones. Read it back with pd.read_parquet(save_path).
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet output requires pyarrow, install it with: pip install pyarrow')
+        fa_scores = fa_scores.astype({col: np.float32 for col in score_cols if fa_scores[col].dtype.kind == 'f'})
+        table = pa.Table.from_pandas(fa_scores, preserve_index=False)
+        pq.write_to_dataset(table, root_path=save_path, partition_cols=partition_cols or None,
+                            basename_template=f'part-{os.getpid()}-{time.time_ns()}-{{i}}.parquet')
+
+    @staticmethod
+    def output_columns(save_path):
+        """:return: the column names of an existing csv file or parquet dataset"""
+        if os.path.isdir(save_path):
+            import pyarrow.dataset as ds
+            return ds.dataset(save_path, format='parquet', partitioning='hive').schema.names
+        return pd.read_csv(save_path, nrows=0).columns.tolist()
+
+    @staticmethod
+    def match_csv_header(fa_scores, save_path):
+        """
+        :return: fa_scores with the columns of the existing csv save_path, in its order, to be appended under its
+            header. The doc_hash column is left out of files written without it (e.g. by a run that was not
+            incremental), where the keys are the hashes of the rows instead, see load_done_keys
+        """
+        header = FrameAxis.output_columns(save_path)
+        if 'doc_hash' in fa_scores.columns and 'doc_hash' not in header:
+            fa_scores = fa_scores.drop(columns=['doc_hash'])
+        if set(fa_scores.columns) != set(header):
+            raise ValueError(
+                f"Can't append the scores to {save_path}, its columns differ: missing from the file "
+                f"{sorted(set(fa_scores.columns) - set(header))}, missing from the scores "
+                f"{sorted(set(header) - set(fa_scores.columns))}. Write them to a new file instead")
+        return fa_scores[header]
+
+    @staticmethod
+    def read_columns(save_path, columns):
+        """:return: iterator over DataFrame chunks of the columns of a csv file (read as strings) or parquet dataset"""
+        if os.path.isdir(save_path):
+            import pyarrow.dataset as ds
+            for batch in ds.dataset(save_path, format='parquet', partitioning='hive').to_batches(columns=columns):
+                yield batch.to_pandas()[columns]
+        elif os.path.isfile(save_path):
+            for chunk in pd.read_csv(save_path, usecols=columns, dtype=str, chunksize=1000000):
+                yield chunk[columns]
+
+    @staticmethod
+    def key_values(df, key_col=None, columns=None):
+        """
+        :param columns: the columns of the rows to hash, by default all of them but doc_hash
+        :return: Series of the key of every row as a string, its key_col or else a hash of the whole row. The values
+            are hashed as text (missing ones as empty), so that a row read back from a saved csv keeps its key
+        """
+        if key_col:
+            return df[key_col].astype(str)
+        rows = df[[col for col in (df.columns if columns is None else columns) if col != 'doc_hash']]
+        rows = rows.astype(object).where(rows.notna(), '').astype(str)
+        return pd.Series([f'{h:016x}' for h in pd.util.hash_pandas_object(rows, index=False)],
+                         index=df.index, dtype=object)
+
+    @staticmethod
+    def doc_keys(df, key_col=None):
+        """:return: uint64 hashes of key_values, the doc_hash column when the rows were keyed by their hash"""
+        if not key_col and 'doc_hash' in df.columns:
+            values = df['doc_hash'].astype(str)
+        else:
+            values = FrameAxis.key_values(df, key_col)
+        return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+    @staticmethod
+    def checkpoint_keys(save_path, keys):
+        """Append the keys of the docs just scored (including the empty docs that were dropped)"""
+        with open(f'{save_path}.keys', 'ab') as f:
+            np.asarray(keys, dtype=np.uint64).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def load_done_keys(save_path, key_name, input_columns=None):
+        """
+        :return: sorted uint64 hashes of the keys of the docs already scored: the checkpoint of save_path together
+            with the key_name column of save_path itself, in case a run stopped between writing the two. An output
+            written without a doc_hash column (e.g. by a run that was not incremental) is keyed by hashing its
+            input_columns, the columns of the input rows, instead
+        """
+        done = [np.empty(0, dtype=np.uint64)]
+        if os.path.isfile(f'{save_path}.keys'):
+            with open(f'{save_path}.keys', 'rb') as f:
+                raw = f.read()
+            # a run killed while checkpointing may leave a truncated last key
+            done.append(np.frombuffer(raw[:len(raw) - len(raw) % 8], dtype=np.uint64))
+        if os.path.exists(save_path):
+            columns = FrameAxis.output_columns(save_path)
+            input_columns = [col for col in input_columns or [] if col != 'doc_hash']
+            if key_name not in columns and key_name == 'doc_hash' and input_columns and \
+                    set(input_columns) <= set(columns):
+                for rows in FrameAxis.read_columns(save_path, input_columns):
+                    done.append(FrameAxis.doc_keys(rows))
+            elif key_name not in columns:
+                raise ValueError(f'{save_path} has no {key_name} column to tell the docs already scored, '
+                                 f'pass its key column as key_col or write the scores to a new file')
+            else:
+                for values in FrameAxis.read_columns(save_path, [key_name]):
+                    done.append(pd.util.hash_pandas_object(values[key_name].astype(str), index=False).to_numpy())
+        return np.unique(np.concatenate(done))
+
+    def get_fa_scores_stream(self, read_chunks, doc_colname, save_path=None, tfidf=False,
+                             format="virtue_vice", n_jobs=1, baseline_frac=None, baseline_seed=157,
+                             incremental=False, key_col=None, output_format="csv", partition_cols=None,
+                             scores_only=False, top_k=0):
+        """
+        Streaming version of get_fa_scores for inputs larger than memory: every chunk is deduplicated against the
+        rows seen before it, preprocessed, scored and appended to save_path, so only one chunk is held at a time.
+        The rows written are the same as get_fa_scores on the whole (drop_duplicates-ed) input: a first pass finds
+        the dtype of every column over the whole input (see stream_dtypes) and all the chunks are cast to it, so that
+        e.g. an integer column with missing values in later chunks only is written as floats in every chunk.
+        :param read_chunks: callable returning a fresh iterator over DataFrame chunks, e.g.
+            lambda: pd.read_csv(input_file, chunksize=100000). It is read once for the dtypes, twice more in tfidf
+            mode to fit the tf-idf on the whole corpus, and once more to count the baseline when baseline_frac is set.
+        :param incremental, key_col, output_format, partition_cols, scores_only, top_k: see get_fa_scores.
+            Progress is checkpointed after every chunk, and an interrupted run picks up from the last chunk saved.
+            The tf-idf and baseline still cover the whole input.
+        :return: number of rows scored
+        """
+        dtypes = self.stream_dtypes(read_chunks())
+        read_raw_chunks = read_chunks
+        read_chunks = lambda: (self._cast_chunk(chunk, dtypes) for chunk in read_raw_chunks())
+
+        # the tf-idf and the baseline are fit on the tokens of each group of dictionaries, see groups
+        tokenizers = [fa for fa, _ in self.groups] or [self]
+        tfidf_vectorizer, avg_tfidf = None, None
+        if tfidf:
+            print('Fitting tfidf over the whole input')
+            with self.metrics.stage('tfidf'):
+                fits = [fa.fit_tfidf_stream(
+                    lambda fa=fa: (fa.preprocess(chunk[doc_colname])
+                                   for chunk in self._drop_duplicate_chunks(read_chunks())))
+                    for fa in tokenizers]
+            tfidf_vectorizer, avg_tfidf = [fit[0] for fit in fits], [fit[1] for fit in fits]
+
+        baseline_counts = None
+        if baseline_frac:
+            print('Counting the baseline tokens over the whole input')
+            baseline_counts = [np.zeros(len(self.model.index_to_key), dtype=np.int64) for _ in tokenizers]
+            with self.metrics.stage('baseline'):
+                for chunk in self._drop_duplicate_chunks(read_chunks()):
+                    docs = chunk[doc_colname]
+                    baseline_docs = docs[self.sample_mask(docs, baseline_frac, baseline_seed)]
+                    baseline_counts = [fa.baseline_counts(fa.preprocess(baseline_docs), counts)
+                                       for fa, counts in zip(tokenizers, baseline_counts)]
+
+        if not self.groups:
+            tfidf_vectorizer, avg_tfidf, baseline_counts = (values[0] if values is not None else None for values in
+                                                            (tfidf_vectorizer, avg_tfidf, baseline_counts))
+
+        done_keys = None
+        if incremental and save_path:
+            done_keys = self.load_done_keys(save_path, key_col or 'doc_hash', list(dtypes))
+
+        n_scored, n_chunks = 0, 0
+        for chunk in self._drop_duplicate_chunks(read_chunks()):
+            print(f'Scoring chunk {n_chunks} ({chunk.shape[0]} rows)')
+            fa_scores = self.get_fa_scores(chunk, doc_colname, save_path=save_path, tfidf=tfidf, format=format,
+                                           tfidf_vectorizer=tfidf_vectorizer, avg_tfidf=avg_tfidf, n_jobs=n_jobs,
+                                           baseline_counts=baseline_counts, incremental=incremental,
+                                           key_col=key_col, done_keys=done_keys, output_format=output_format,
+                                           partition_cols=partition_cols, scores_only=scores_only, top_k=top_k)
+            if done_keys is not None:
+                done_keys = np.union1d(done_keys, self.doc_keys(chunk, key_col))
+            n_scored += fa_scores.shape[0]
+            n_chunks += 1
+            self.metrics.count('chunks')
+        print(f'Scored {n_scored} rows in {n_chunks} chunks')
+        return n_scored
+
+    @staticmethod
+    def stream_dtypes(chunks):
+        """
+        :return: dtype of every column over all the chunks, as inferred when reading the whole input at once: the
+            common numeric type when the chunks only disagree on numeric types (int64 and float64 give float64),
+            object otherwise
+        """
+        chunk_dtypes = {}
+        for chunk in chunks:
+            for col, dtype in chunk.dtypes.items():
+                chunk_dtypes.setdefault(col, set()).add(dtype)
+        dtypes = {}
+        for col, col_dtypes in chunk_dtypes.items():
+            if len(col_dtypes) == 1:
+                dtypes[col] = col_dtypes.pop()
+            elif all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                     for dtype in col_dtypes):
+                dtypes[col] = np.result_type(*col_dtypes)
+            else:
+                dtypes[col] = np.dtype(object)
+        return dtypes
+
+    @staticmethod
+    def _cast_chunk(chunk, dtypes):
+        cast = {col: dtype for col, dtype in dtypes.items() if col in chunk.columns and chunk[col].dtype != dtype}
+        return chunk.astype(cast) if cast else chunk
+
+    @staticmethod
+    def _drop_duplicate_chunks(chunks):
+        """drop_duplicates across a stream of DataFrame chunks, remembering only a 64 bit hash per distinct row"""
+        seen = np.empty(0, dtype=np.uint64)
+        for chunk in chunks:
+            hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+            pos = np.minimum(np.searchsorted(seen, hashes), max(len(seen) - 1, 0))
+            is_new = ~pd.Series(hashes).duplicated().to_numpy()
+            if len(seen):
+                is_new &= seen[pos] != hashes
+            seen = np.sort(np.concatenate([seen, hashes[is_new]]), kind='stable')
+            chunk = chunk[is_new]
+            if chunk.shape[0]:
+                yield chunk
+
+
+# state of the scoring processes of FrameAxis.worker_pool
+_scoring_worker = None
+_scoring_worker_shm = None
+
+
+def _init_scoring_worker(mfd, axes, vocab, projections_source, phrases):
+    global _scoring_worker, _scoring_worker_shm
+    if projections_source[0] == 'mmap':
+        projections = np.load(projections_source[1], mmap_mode='r')
+    else:
+        _, name, shape, dtype = projections_source
+        _scoring_worker_shm = shared_memory.SharedMemory(name=name)
+        projections = np.ndarray(shape, dtype=dtype, buffer=_scoring_worker_shm.buf)
+    _scoring_worker = FrameAxis(mfd=mfd, w2v_model=vocab, axes=axes, projections=projections, phrases=phrases)
+
+
+def _score_batch(task):
+    docs, tfidf, B_T, per_doc_tfidf, tfidf_state, top_k = task
+    if tfidf:
+        # already preprocessed, see FrameAxis.parallel_doc_scores
+        _scoring_worker.fit_tfidf(docs, *tfidf_state)
+    else:
+        docs = _scoring_worker.preprocess(docs).reset_index(drop=True)
+    return _scoring_worker.score_docs(docs, B_T, tfidf, per_doc_tfidf, top_k)
+
+
+def _count_batch(docs):
+    token_ids, _ = _scoring_worker.encode_docs(_scoring_worker.preprocess(docs).str.lower())
+    return np.unique(token_ids, return_counts=True)
@@ -0,0 +1,107 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+def rss_mb():
+    """Current resident memory of the process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss_mb():
+    """Peak resident memory of the process so far"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class RunMetrics:
+    """
+    Wall time and memory of the stages of a scoring run (load, preprocess, axes, score, save, ...) along with
+    throughput counters, written as JSON next to the output file. Stages run several times, e.g. once per chunk,
+    are accumulated.
+    """
+
+    def __init__(self, profile=False) -> None:
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.counters = Counter()
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler:
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name):
+        rss_start = rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rss_delta_mb': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += time.perf_counter() - start
+            rss_end = rss_mb()
+            if rss_start is not None and rss_end is not None:
+                stage['rss_delta_mb'] += rss_end - rss_start
+            stage['rss_end_mb'] = rss_end
+            stage['max_rss_mb'] = max_rss_mb()
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def profile_stats(self, n_functions=30):
+        """:return: the n_functions with the highest cumulative time in the cProfile of the run"""
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        rows = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({'function': f'{os.path.basename(filename)}:{line}({function})', 'calls': calls,
+                         'tottime': round(tottime, 4), 'cumtime': round(cumtime, 4)})
+        return sorted(rows, key=lambda row: -row['cumtime'])[:n_functions]
+
+    def to_dict(self):
+        wall_seconds = time.perf_counter() - self._start
+        score_seconds = self.stages.get('score', {}).get('seconds')
+        metrics = {
+            'started_at': self.started_at,
+            'wall_seconds': round(wall_seconds, 4),
+            'max_rss_mb': round(max_rss_mb(), 1),
+            'stages': {name: {key: round(value, 4) if isinstance(value, float) else value
+                              for key, value in stage.items()} for name, stage in self.stages.items()},
+            'counters': dict(self.counters),
+            'throughput': {
+                'docs_per_sec': round(self.counters['docs_scored'] / wall_seconds, 1),
+                'score_docs_per_sec': round(self.counters['docs_scored'] / score_seconds, 1)
+                if score_seconds else None,
+                'score_tokens_per_sec': round(self.counters['tokens'] / score_seconds, 1) if score_seconds else None,
+            },
+        }
+        if self.profiler:
+            self.profiler.disable()
+            metrics['profile'] = self.profile_stats()
+            self.profiler.enable()
+        return metrics
+
+    def write(self, output_path):
+        """Write the metrics to {output_path}.metrics.json, and the raw cProfile to {output_path}.prof"""
+        metrics = self.to_dict()
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(f'{output_path}.prof')
+            self.profiler.enable()
+        with open(f'{output_path}.metrics.{os.getpid()}.tmp', 'w') as f:
+            json.dump(metrics, f, indent=2)
+        os.replace(f'{output_path}.metrics.{os.getpid()}.tmp', f'{output_path}.metrics.json')
+        return metrics
@@ -0,0 +1,85 @@
+import re
+
+_END = None  # trie key of the phrase ending at a node, tokens are never None
+
+
+class PhraseMatcher:
+    """
+    Trie of multiword dictionary entries (e.g. mfd2's "level the playing field") that merges their occurrences in a
+    tokenized document into single underscore-joined tokens ("level_the_playing_field"), as in the word embedding
+    vocabulary. Matches are leftmost-longest and found in a single scan, so documents need no n-gram model.
+    """
+
+    def __init__(self, phrases, separator='_'):
+        """:param phrases: phrases as strings of words joined by separator or whitespace"""
+        self.separator = separator
+        self.trie = {}
+        for phrase in phrases:
+            words = phrase.replace(separator, ' ').split()
+            if len(words) < 2:
+                continue
+            node = self.trie
+            for word in words:
+                node = node.setdefault(word, {})
+            node[_END] = separator.join(words)
+        # texts without the first word of any phrase skip the token scan
+        first_words = sorted(self.trie, key=len, reverse=True)
+        self._first_word = re.compile(r'(?<![a-z_])(?:' + '|'.join(map(re.escape, first_words)) + r')(?![a-z_])') \
+            if first_words else None
+
+    @classmethod
+    def from_dictionary(cls, words_df, vocab=None, separator='_'):
+        """
+        :param words_df: moral foundation dictionary with a word column, see FrameAxis.read_dictionary
+        :param vocab: only keep the phrases of this vocabulary (e.g. the embedding model's), the others can't be scored
+        """
+        phrases = [word for word in words_df['word'].dropna().astype(str).unique() if separator in word]
+        if vocab is not None:
+            phrases = [phrase for phrase in phrases if phrase in vocab]
+        return cls(phrases, separator)
+
+    def __len__(self):
+        return sum(1 for _ in self._phrases(self.trie))
+
+    def phrases(self):
+        """:return: set of the joined phrases matched"""
+        return set(self._phrases(self.trie))
+
+    def _phrases(self, node):
+        for word, child in node.items():
+            if word is _END:
+                yield child
+            else:
+                yield from self._phrases(child)
+
+    def in_text(self, text):
+        return self._first_word is not None and self._first_word.search(text) is not None
+
+    def merge(self, tokens):
+        """
+        Replace every phrase occurring in tokens by its joined token. Empty or whitespace tokens (from repeated
+        spaces, or the separators kept by re.split(r'(\s+)', text)) inside a phrase are dropped with it, everywhere
+        else tokens are left untouched.
+        """
+        merged = []
+        i, n = 0, len(tokens)
+        while i < n:
+            node = self.trie.get(tokens[i]) if tokens[i] else None
+            match, match_end = None, None
+            j = i + 1
+            while node is not None:
+                if _END in node:
+                    match, match_end = node[_END], j
+                while j < n and (not tokens[j] or tokens[j].isspace()):
+                    j += 1
+                if j == n:
+                    break
+                node = node.get(tokens[j])
+                j += 1
+            if match is None:
+                merged.append(tokens[i])
+                i += 1
+            else:
+                merged.append(match)
+                i = match_end
+        return merged
@@ -1,6 +1,9 @@
 import re
+from functools import partial
+from multiprocessing import Pool
 
 import nltk
+import pandas as pd
 
 sno = nltk.stem.SnowballStemmer('english')
 stop_words = [' rt ', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll",
@@ -41,20 +44,96 @@ def deEmojify(text):
     return regrex_pattern.sub(r'', text)
 
 
-def preprocess(tweets):
-    '''remove hashtags and urls'''
-    tweets = tweets.str.replace(r'(?:\@|https?\://)\S+', ' ', regex=True)
-    tweets = tweets.apply(deEmojify)
-    tweets = tweets.str.lower()
-    tweets = tweets.str.replace('rt :', '')
-    tweets = tweets.str.replace(r'[^\w\s]', ' ', regex=True)
-    tweets = tweets.str.replace(r'[^a-zA-z\s]', ' ', regex=True)  # r'[^a-zA-z0-9\s]'
-    
-    '''remove stopwords'''
-    for s_word in stop_words:
-        tweets = tweets.str.replace(' ' + s_word + ' ', ' ')
-    tweets = tweets.apply(_sanitize)
-    return tweets
+# compiled once for preprocess_doc: urls and mentions are replaced by a space, emoji are dropped
+_url_or_emoji = re.compile(r'((?:\@|https?\://)\S+)|['
+                           u"\U0001F600-\U0001F64F"  # emoticons
+                           u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+                           u"\U0001F680-\U0001F6FF"  # transport & map symbols
+                           u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
+                           "]+", flags=re.UNICODE)
+# the union of [^\w\s] and [^a-zA-z\s]
+_non_alpha = re.compile(r'[^a-zA-Z_\s]')
+_whitespace = re.compile(r'(\s+)')
+_stop_word_rank = {s_word: rank for rank, s_word in enumerate(stop_words) if s_word != ' rt '}
+
+
+def _url_or_emoji_repl(match):
+    return ' ' if match.group(1) else ''
+
+
+def _remove_stop_words(tokens):
+    """
+    Drops stop words from the space separated tokens exactly as successive str.replace(' ' + s_word + ' ', ' ')
+    calls in stop_words order would: the first and last tokens are never removed, and since the matches of
+    one replace cannot overlap, it only removes every other word of a run of the same stop word.
+    Only runs of consecutive stop words need replaying the replaces, any other token is kept as is.
+    """
+    kept = [tokens[0]]
+    run = []
+    for token in tokens[1:-1]:
+        if token in _stop_word_rank:
+            run.append(token)
+            continue
+        if len(run) > 1:
+            kept.extend(_replay_stop_word_run(run))
+        run = []
+        kept.append(token)
+    if len(run) > 1:
+        kept.extend(_replay_stop_word_run(run))
+    kept.append(tokens[-1])
+    return kept
+
+
+def _replay_stop_word_run(run):
+    for s_word in sorted(set(run), key=_stop_word_rank.get):
+        remaining = []
+        prev_removed = False
+        for token in run:
+            if token == s_word and not prev_removed:
+                prev_removed = True
+            else:
+                remaining.append(token)
+                prev_removed = False
+        run = remaining
+    return run
+
+
+def preprocess_doc(text, phrases=None):
+    """Single pass version of preprocess for one document, see preprocess"""
+    if not isinstance(text, str):
+        return ""
+    text = _url_or_emoji.sub(_url_or_emoji_repl, text)
+    text = text.lower().replace('rt :', '')
+    text = _non_alpha.sub(' ', text)
+    text = text.replace('  rt  ', ' ')
+    if phrases is not None and phrases.in_text(text):
+        # before the stop words are dropped, as phrases like "eye for an eye" hold some. Split on any whitespace
+        # (newlines and tabs too) keeping the separators, so the stop words below still see the same spacing
+        text = ''.join(phrases.merge(_whitespace.split(text)))
+    tokens = text.split(' ')
+    if len(tokens) > 2:
+        tokens = _remove_stop_words(tokens)
+    return " ".join(" ".join(tokens).split())
+
+
+def _preprocess_docs(docs, phrases=None):
+    return [preprocess_doc(doc, phrases) for doc in docs]
+
+
+def preprocess(tweets, n_jobs=1, phrases=None):
+    '''
+    remove hashtags and urls, emoji, punctuation, digits and stopwords, lowercase and collapse whitespace.
+    Each document is cleaned in a single pass by preprocess_doc, over n_jobs processes if n_jobs > 1.
+    phrases, a PhraseMatcher, merges the multiword dictionary entries of the docs into single tokens.
+    '''
+    if n_jobs > 1 and len(tweets) > n_jobs:
+        batch_size = -(-len(tweets) // (n_jobs * 4))
+        batches = [tweets.iloc[start:start + batch_size].tolist() for start in range(0, len(tweets), batch_size)]
+        with Pool(n_jobs) as pool:
+            docs = [doc for batch in pool.map(partial(_preprocess_docs, phrases=phrases), batches) for doc in batch]
+    else:
+        docs = _preprocess_docs(tweets, phrases)
+    return pd.Series(docs, index=tweets.index, name=tweets.name, dtype=object)
 
 
 def remove_stopwords(tweet):
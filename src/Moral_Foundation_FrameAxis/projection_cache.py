@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def model_fingerprint(model, n_sample_rows=1024):
+    """
+    Identify a KeyedVectors model by its vocabulary and a sample of its vectors.
+    Only the sampled rows are read, so this stays cheap on memory-mapped models.
+    """
+    sha = hashlib.sha1()
+    sha.update(f'{len(model.index_to_key)}:{model.vector_size}:{model.vectors.dtype}'.encode())
+    sha.update('\n'.join(model.index_to_key).encode('utf-8'))
+    rows = np.unique(np.linspace(0, len(model.index_to_key) - 1, n_sample_rows).astype(np.int64))
+    sha.update(np.ascontiguousarray(model.vectors[rows]).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def dictionary_checksum(words_df):
+    return hashlib.sha1(pd.util.hash_pandas_object(words_df, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def axes_checksum(axes):
+    sha = hashlib.sha1()
+    for mf, axis in axes.items():
+        sha.update(mf.encode())
+        sha.update(np.asarray(axis, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+class ProjectionCache:
+    """
+    Disk-backed table of cosine similarities between every word of an embedding model and the moral foundation axes,
+    along with the axes themselves.
+
+    Layout:
+        {cache_dir}/{model fingerprint}/tokens.txt                   token index, one token per row of the table
+        {cache_dir}/{model fingerprint}/{dict_type}/frame_axes.npz   axis names and vectors, dictionary checksum
+        {cache_dir}/{model fingerprint}/{dict_type}/oov_words.json   dictionary words missing from the model, per axis
+        {cache_dir}/{model fingerprint}/{dict_type}/projections.npy  (vocab x axes) float32 table
+        {cache_dir}/{model fingerprint}/{dict_type}/axes.json        axis names (column order) and axes checksum
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self._fingerprints = {}
+
+    def fingerprint(self, model):
+        # hashing the vocabulary of a large model takes a moment, so it is done once per model
+        if id(model) not in self._fingerprints:
+            self._fingerprints[id(model)] = (model, model_fingerprint(model))
+        return self._fingerprints[id(model)][1]
+
+    def _model_dir(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def _dict_dir(self, fingerprint, dict_type):
+        return os.path.join(self.cache_dir, fingerprint, dict_type)
+
+    def load_axes(self, model, dict_type, words_df):
+        """
+        :return: the cached axes and out of vocabulary words of the dictionary words_df, or None if they are not
+            cached or the dictionary changed since
+        """
+        dict_dir = self._dict_dir(self.fingerprint(model), dict_type)
+        try:
+            cached = np.load(os.path.join(dict_dir, 'frame_axes.npz'))
+            with open(os.path.join(dict_dir, 'oov_words.json')) as f:
+                oov_words = json.load(f)
+        except FileNotFoundError:
+            return None
+        if str(cached['dict_checksum']) != dictionary_checksum(words_df):
+            print(f'The {dict_type} dictionary changed since its axes were cached, rebuilding them')
+            return None
+        print(f'Loaded {dict_type} axes from {dict_dir}')
+        return dict(zip(cached['names'].tolist(), cached['axes'])), oov_words
+
+    def save_axes(self, model, dict_type, words_df, axes, oov_words):
+        dict_dir = self._dict_dir(self.fingerprint(model), dict_type)
+        os.makedirs(dict_dir, exist_ok=True)
+        with open(os.path.join(dict_dir, f'oov_words.{os.getpid()}.tmp'), 'w') as f:
+            json.dump(oov_words, f)
+        os.replace(os.path.join(dict_dir, f'oov_words.{os.getpid()}.tmp'), os.path.join(dict_dir, 'oov_words.json'))
+        with open(os.path.join(dict_dir, f'frame_axes.{os.getpid()}.tmp'), 'wb') as f:
+            np.savez(f, names=np.array(list(axes.keys())), axes=np.array(list(axes.values())),
+                     dict_checksum=np.array(dictionary_checksum(words_df)))
+        os.replace(os.path.join(dict_dir, f'frame_axes.{os.getpid()}.tmp'), os.path.join(dict_dir, 'frame_axes.npz'))
+
+    def load(self, model, dict_type, axes):
+        """
+        :return: the memory-mapped (vocab x axes) projection table, or None if it is not cached (or is stale)
+        """
+        dict_dir = self._dict_dir(self.fingerprint(model), dict_type)
+        try:
+            with open(os.path.join(dict_dir, 'axes.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta['axes'] != list(axes.keys()) or meta['axes_checksum'] != axes_checksum(axes):
+            print(f'Projection cache at {dict_dir} was built with different axes, rebuilding it')
+            return None
+        projections = np.load(os.path.join(dict_dir, 'projections.npy'), mmap_mode='r')
+        print(f'Loaded axis projections from {dict_dir}')
+        return projections
+
+    def build(self, model, dict_type, axes, project):
+        """
+        Write the projection table straight to disk, chunk by chunk, and return it memory-mapped.
+        :param project: callable mapping a (rows x dim) block of model vectors to its (rows x axes) projections
+        """
+        fingerprint = self.fingerprint(model)
+        dict_dir = self._dict_dir(fingerprint, dict_type)
+        os.makedirs(dict_dir, exist_ok=True)
+
+        tokens_path = os.path.join(self._model_dir(fingerprint), 'tokens.txt')
+        if not os.path.isfile(tokens_path):
+            with open(f'{tokens_path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(model.index_to_key))
+            os.replace(f'{tokens_path}.{os.getpid()}.tmp', tokens_path)
+
+        print(f'Building axis projections for {len(model.index_to_key)} words into {dict_dir}')
+        # write under a temporary name so that concurrent scorers never see a half-written table
+        tmp_path = os.path.join(dict_dir, f'projections.{os.getpid()}.tmp.npy')
+        table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                          shape=(len(model.index_to_key), len(axes)))
+        chunk_size = 100000
+        for start in range(0, table.shape[0], chunk_size):
+            table[start:start + chunk_size] = project(model.vectors[start:start + chunk_size])
+        table.flush()
+        del table
+        os.replace(tmp_path, os.path.join(dict_dir, 'projections.npy'))
+
+        with open(os.path.join(dict_dir, f'axes.{os.getpid()}.tmp'), 'w') as f:
+            json.dump({'axes': list(axes.keys()), 'axes_checksum': axes_checksum(axes)}, f)
+        os.replace(os.path.join(dict_dir, f'axes.{os.getpid()}.tmp'), os.path.join(dict_dir, 'axes.json'))
+        return np.load(os.path.join(dict_dir, 'projections.npy'), mmap_mode='r')
+
+    def load_or_build(self, model, dict_type, axes, project):
+        projections = self.load(model, dict_type, axes)
+        if projections is None:
+            projections = self.build(model, dict_type, axes, project)
+        return projections
+
+    def token_index(self, model):
+        """Token -> row of the projection table, read from the token index on disk."""
+        with open(os.path.join(self._model_dir(self.fingerprint(model)), 'tokens.txt'), encoding='utf-8') as f:
+            return {token: i for i, token in enumerate(f.read().split('\n'))}
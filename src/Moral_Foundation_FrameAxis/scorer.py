@@ -3,30 +3,82 @@ import pandas as pd
 
 from gensim.models import KeyedVectors
 
-from frameAxis import FrameAxis
+from embedding_subset import build_embedding_subset, subset_is_current
+from frameAxis import DICT_TYPES, FrameAxis
+from metrics import RunMetrics
 from utils import read_json
 
 class MoralFoundationScorer:
     def __init__(
             self, 
             input_file: str, 
-            dict_type: str, 
+            dict_type: str | list, 
             output_file: str, 
             docs_col: str, 
             model_path: str, 
             tfidf: bool=False, 
-            format: str="virtue_vice") -> None:
+            format: str="virtue_vice",
+            cache_dir: str=None,
+            model_subset_path: str=None,
+            chunksize: int=None,
+            n_jobs: int=1,
+            baseline_frac: float=None,
+            baseline_seed: int=157,
+            incremental: bool=False,
+            key_col: str=None,
+            output_format: str="csv",
+            partition_cols: list=None,
+            scores_only: bool=False,
+            profile: bool=False,
+            top_k: int=0) -> None:
         
+        # stage timings and counters, written next to the output file as {output_file}.metrics.json
+        self.metrics = RunMetrics(profile=profile)
         self.input_file = f"./data/{input_file}"
         self.output_file = f"./data/{output_file}"
-        self.dict_type = dict_type # if DICT_TYPE not in ["emfd", "mfd", "mfd2", "customized"]:
+        self.dict_type = dict_type # one of DICT_TYPES, or a list of them scored together in a single pass
         self.docs_col = docs_col
-        self.model = self.setup_model(model_path)
+        with self.metrics.stage('load'):
+            self.model = self.setup_model(model_path, model_subset_path)
         self.tfidf = tfidf
         self.format = format
+        self.cache_dir = cache_dir # axis projections are cached here per model and dict_type, None disables caching
+        self.chunksize = chunksize # stream the input in chunks of this many rows, None scores it all at once
+        self.n_jobs = n_jobs # number of scoring processes
+        self.baseline_frac = baseline_frac # fraction of the corpus sampled as baseline, None scores without one
+        self.baseline_seed = baseline_seed
+        self.incremental = incremental # only score the docs not yet in output_file, see FrameAxis.get_fa_scores
+        self.key_col = key_col # column identifying the docs, by default they are keyed by a hash of their text
+        self.output_format = output_format # "csv" or "parquet", a parquet output_file is a dataset directory
+        self.partition_cols = partition_cols # e.g. ["subreddit"], to partition the parquet output by
+        self.scores_only = scores_only # only save the key and score columns, not the documents
+        self.top_k = top_k # number of top contributing tokens listed per doc and foundation, 0 for none
+
+    def setup_model(self, model_path: str='word2vec-google-news-300.bin', model_subset_path: str=None):
+        """
+        Loads the word embedding model read-only memory-mapped from gensim's native format (a .kv file plus a
+        .vectors.npy file next to it), so that loading takes seconds and concurrent scorers share the page cache.
+        The word2vec binary at model_path (downloaded if missing) is converted to that format on the first run.
+
+        If model_subset_path is given, the corpus-pruned subset saved there is loaded instead of the full model,
+        building it from the input file on the first run (see embedding_subset.py). The subset is rebuilt when
+        the input file changed since, otherwise the new tokens of the corpus would be scored as out of vocabulary.
+        """
+        if model_subset_path and os.path.isfile(model_subset_path):
+            if subset_is_current(model_subset_path, self.input_file, self.docs_col):
+                print(f'Memory-mapping word embedding subset: {model_subset_path}')
+                return KeyedVectors.load(model_subset_path, mmap='r')
+            print(f'The input file changed since the embedding subset {model_subset_path} was built, rebuilding it')
+        if model_subset_path:
+            return build_embedding_subset(self.setup_model(model_path), self.input_file, self.docs_col,
+                                          model_subset_path)
 
-    def setup_model(self, model_path: str='word2vec-google-news-300.bin'):
         model = model_path.split(".")[0]
+        kv_path = model_path if model_path.endswith('.kv') else f'{os.path.splitext(model_path)[0]}.kv'
+
+        if os.path.isfile(kv_path):
+            print(f'Memory-mapping word embedding model: {kv_path}')
+            return KeyedVectors.load(kv_path, mmap='r')
 
         if os.path.isfile(model_path):
             model = KeyedVectors.load_word2vec_format(model_path, binary=True)
@@ -36,24 +88,61 @@ class MoralFoundationScorer:
             model = gensim.downloader.load(model)
             model.save_word2vec_format(model_path, binary=True)
             print(f"Model downloaded and saved at {model_path}")
-        
-        return model
+
+        model.save(kv_path, separately=['vectors'])
+        print(f'Model converted for memory-mapped loading and saved at {kv_path}')
+        del model
+        return KeyedVectors.load(kv_path, mmap='r')
     
     def score(self) -> pd.DataFrame:
-        if self.dict_type not in ["emfd", "mfd", "mfd2", "customized"]:
-            raise ValueError(
-                f'Invalid dictionary type received: {self.dict_type}, dict_type must be one of \"emfd\", \"mfd\", \"mfd2\", \"customized\"')
+        for dict_type in FrameAxis.dict_type_list(self.dict_type):
+            if dict_type not in DICT_TYPES:
+                raise ValueError(
+                    f'Invalid dictionary type received: {dict_type}, dict_type must be one of \"emfd\", \"mfd\", \"mfd2\", \"customized\" or a list of them')
+
+        fa = FrameAxis(mfd=self.dict_type, w2v_model=self.model, cache_dir=self.cache_dir, metrics=self.metrics)
+
+        if self.chunksize:
+            # scores are only written to the output file, nothing is returned
+            fa.get_fa_scores_stream(
+                read_chunks=lambda: pd.read_csv(self.input_file, on_bad_lines='skip', encoding='utf-8',
+                                                chunksize=self.chunksize),
+                doc_colname=self.docs_col,
+                tfidf=self.tfidf,
+                format=self.format,
+                save_path=self.output_file,
+                n_jobs=self.n_jobs,
+                baseline_frac=self.baseline_frac,
+                baseline_seed=self.baseline_seed,
+                incremental=self.incremental,
+                key_col=self.key_col,
+                output_format=self.output_format,
+                partition_cols=self.partition_cols,
+                scores_only=self.scores_only,
+                top_k=self.top_k)
+            self.metrics.write(self.output_file)
+            return None
 
-        data = pd.read_csv(self.input_file, on_bad_lines='skip', encoding='utf-8').drop_duplicates()
+        with self.metrics.stage('read'):
+            data = pd.read_csv(self.input_file, on_bad_lines='skip', encoding='utf-8').drop_duplicates()
         print(data.head())
 
-        fa = FrameAxis(mfd=self.dict_type, w2v_model=self.model)
         mf_scores = fa.get_fa_scores(
             df=data, 
             doc_colname=self.docs_col, 
             tfidf=self.tfidf, 
             format=self.format,
-            save_path=self.output_file)
+            save_path=self.output_file,
+            n_jobs=self.n_jobs,
+            baseline_frac=self.baseline_frac,
+            baseline_seed=self.baseline_seed,
+            incremental=self.incremental,
+            key_col=self.key_col,
+            output_format=self.output_format,
+            partition_cols=self.partition_cols,
+            scores_only=self.scores_only,
+            top_k=self.top_k)
+        self.metrics.write(self.output_file)
         
         return mf_scores
 
@@ -67,6 +156,19 @@ if __name__ == "__main__":
         docs_col=config["docs_col"],
         model_path=config["model_path"],
         tfidf=eval(config["tfidf"]),
-        format=config["format"])
+        format=config["format"],
+        cache_dir=config.get("cache_dir"),
+        model_subset_path=config.get("model_subset_path"),
+        chunksize=config.get("chunksize"),
+        n_jobs=config.get("n_jobs", 1),
+        baseline_frac=config.get("baseline_frac"),
+        baseline_seed=config.get("baseline_seed", 157),
+        incremental=config.get("incremental", False),
+        key_col=config.get("key_col"),
+        output_format=config.get("output_format", "csv"),
+        partition_cols=config.get("partition_cols"),
+        scores_only=config.get("scores_only", False),
+        profile=config.get("profile", False),
+        top_k=config.get("top_k", 0))
     
     scores = scorer.score()
\ No newline at end of file
@@ -1,33 +1,59 @@
 import time
+import threading
 import requests
+import requests.adapters
 import requests.auth
 import logging
 import collections
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+from data_collection.crawl_state import CrawlState
+from data_collection.rate_limiter import RateLimiter
+from data_collection.response_cache import ResponseCache
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
 class ApiInterface:
     def __init__(
             self, 
             auth_keys: list,
             headers: dict = {"User-Agent": "ChangeMeClient/0.1 by YourUsername"},
-            timeout: float = 4) -> None:
+            timeout: float = 4,
+            max_workers: int = 8) -> None:
         
-        self.headers = headers
+        self.headers = dict(headers)  # copied, the Authorization header is per client
         self.auth_keys = auth_keys
         self.timeout = timeout
+        self.max_workers = max_workers  # threads of the concurrent fetches, and size of the connection pool
         self.client_auth = requests.auth.HTTPBasicAuth(*auth_keys)
+        self.session = self._make_session()
+
+    def _make_session(self) -> requests.Session:
+        # keep-alive connections reused across requests and threads, instead of a new TLS handshake per page
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(self.max_workers, 1))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
 
     def post_request(self, url: str, post_data: dict):
-        response = requests.post(url=url, auth=self.client_auth, data=post_data, headers=self.headers, timeout=self.timeout)
+        response = self.session.post(url=url, auth=self.client_auth, data=post_data, headers=self.headers, timeout=self.timeout)
         if response.status_code != 200: 
             raise Exception(f"Failed to get access token: {response.status_code} {response.text}")
         return response.json()
     
     def get_request(self, url: str):
-        response = requests.get(url=url, headers=self.headers)
+        return self._json(self.session.get(url=url, headers=self.headers, timeout=self.timeout))
+
+    @staticmethod
+    def _json(response: requests.Response):
         if response.status_code != 200: 
             raise Exception(f"Failed to get access token: {response.status_code} {response.text}")
         return response.json()
@@ -40,49 +66,109 @@ class RedditApi(ApiInterface):
             password: str,
             auth_url: str,
             headers: dict = {"User-Agent": "ChangeMeClient/0.1 by YourUsername"},
-            timeout: float = 4) -> None:
+            timeout: float = 4,
+            base_url: str = "https://oauth.reddit.com",
+            max_workers: int = 8,
+            max_retries: int = 5,
+            response_cache: ResponseCache = None,
+            crawl_state: CrawlState = None) -> None:
         
-        super().__init__(auth_keys, headers, timeout)
+        super().__init__(auth_keys, headers, timeout, max_workers)
 
         self.username = username
         self.password = password
         self.auth_url = auth_url
+        self.base_url = base_url.rstrip("/")  # e.g. a local fake Reddit server in tests
+        self._token_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(burst=max(max_workers, 1), reserve=max(max_workers, 1))
+        self.max_retries = max_retries  # retries of a request after a 429, a 5xx or a connection error
+        self.response_cache = response_cache  # optional, GET responses are served from it while fresh
+        self.crawl_state = crawl_state  # optional, the listings resume from their saved cursor and results
         self.post_data = {"scope": "read identity history", "grant_type": "password", "username": username, "password": password}
-        self._update_token()
+        if response_cache is not None and response_cache.replay:
+            # replaying a recorded cache never reaches the API, so no token is needed
+            self.token_start_time, self.token_expires_in = time.time(), float("inf")
+        else:
+            self._update_token()
         
     def _token_expired(self):
         if time.time() - self.token_start_time >= self.token_expires_in:
             return True
 
-    def _update_token(self):
-        token = super().post_request(url=self.auth_url, post_data=self.post_data)  # Refresh the token
-        self.token_expires_in = token["expires_in"]
-        self.token_start_time = time.time() 
-        self.headers["Authorization"] = f"{token['token_type']} {token['access_token']}"
+    def _update_token(self, stale_start_time: float = None):
+        # concurrent fetches share the token, only the first thread to find it stale refreshes it
+        with self._token_lock:
+            if stale_start_time is not None and self.token_start_time != stale_start_time:
+                return
+            token = super().post_request(url=self.auth_url, post_data=self.post_data)  # Refresh the token
+            self.token_expires_in = token["expires_in"]
+            self.token_start_time = time.time() 
+            self.headers["Authorization"] = f"{token['token_type']} {token['access_token']}"
         
     def get_request(self, url):
-        try:
-            if self._token_expired():
-                self._update_token()
-            return super().get_request(url)
-        except Exception as e:
-            if "expired" in str(e).lower():
+        """
+        GET url once the rate limiter allows it. 429s, 5xx and connection errors are retried up to max_retries times
+        after backing off, and a 401 is retried once with a refreshed token. With a response_cache, fresh cached
+        responses are returned without a request and new ones are cached.
+        """
+        if self.response_cache is not None:
+            body = self.response_cache.get(url)
+            if body is None:
+                body = self._get_request(url)
+                if body is not None:
+                    self.response_cache.put(url, body)
+            return body
+        return self._get_request(url)
+
+    def _get_request(self, url):
+        if self._token_expired():
+            self._update_token(self.token_start_time)
+        # the token is refreshed at most once per request, besides the max_retries retries
+        attempt, token_refreshed = 0, False
+        while True:
+            token_start_time = self.token_start_time
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url=url, headers=self.headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"Request to {url} failed: {e}")
+                self.rate_limiter.backoff(attempt)
+                attempt += 1
+                continue
+            self.rate_limiter.update(response.headers)
+
+            if response.status_code == 401 and not token_refreshed:
                 logging.info("Refreshing access token and retrying...")
-                self._update_token()
-                try:
-                    return super().get_request(url)
-                except Exception as retry_error:
-                    raise retry_error
-            else:
-                raise e
+                self._update_token(token_start_time)
+                token_refreshed = True
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                logging.warning(f"Got {response.status_code} from {url}, retrying")
+                self.rate_limiter.backoff(attempt, response.headers)
+                attempt += 1
+                continue
+            return self._json(response)
+
+    def _load_state(self, kind: str, name: str) -> dict:
+        state = self.crawl_state.load(kind, name) if self.crawl_state is not None else None
+        if state is not None:
+            logging.info(f"Resuming {kind} of {name} from its saved state")
+        return state
+
+    def _save_state(self, kind: str, name: str, state: dict):
+        if self.crawl_state is not None:
+            self.crawl_state.save(kind, name, state)
 
     def get_top_users_by_karma(self, subreddit: str, limit: int = 100000):
-            user_karma = collections.defaultdict(int)
-            after = None
+            state = self._load_state("top", subreddit) or {"after": None, "finished": False, "user_karma": {}}
+            user_karma = collections.defaultdict(int, state["user_karma"])
+            after = state["after"]
 
-            while len(user_karma.keys()) < limit:
+            while not state["finished"] and len(user_karma.keys()) < limit:
                 # Reddit's 'top' posts endpoint
-                url = f"https://oauth.reddit.com/r/{subreddit}/top?limit=100&t=all"
+                url = f"{self.base_url}/r/{subreddit}/top?limit=100&t=all"
                 if after:
                     url += f"&after={after}"
 
@@ -91,11 +177,13 @@ class RedditApi(ApiInterface):
                 except Exception as e:
                     if "404" in str(e) or "403" in str(e):
                         logging.error(f"Access error: {e}")
+                        break
                     if "429" in str(e):
                         logging.error(f"Rate limit error: {e}")
                         raise Exception("Rate limit exceeded, try again later.")
+                    # get_request already retried, the crawl state keeps the pages fetched so far
                     logging.error(f"Error fetching data: {e}")
-                    continue
+                    raise
 
                 posts = response.get('data', {}).get('children', [])
                 for post in posts:
@@ -108,6 +196,8 @@ class RedditApi(ApiInterface):
 
                 logging.info(f"Total users fetched so far: {len(user_karma.keys())}")
                 after = response.get('data', {}).get('after')
+                state = {"after": after, "finished": not after, "user_karma": user_karma}
+                self._save_state("top", subreddit, state)
 
                 # Stop if there are no more posts to fetch
                 if not after:
@@ -127,7 +217,7 @@ class RedditApi(ApiInterface):
         Returns:
             int: The number of members in the subreddit.
         """
-        url = f"https://oauth.reddit.com/r/{subreddit}/about"
+        url = f"{self.base_url}/r/{subreddit}/about"
         
         try:
             response = self.get_request(url)
@@ -147,10 +237,13 @@ class RedditApi(ApiInterface):
             posts: bool=True):
         
         content_type = "submitted" if posts else "comments"
-        url = f"https://oauth.reddit.com/user/{username}/{content_type}?limit=100"
+        listing_url = f"{self.base_url}/user/{username}/{content_type}?limit=100"
 
-        user_posts = []
-        after = None
+        state = self._load_state(content_type, username) or {"after": None, "finished": False, "posts": []}
+        if state["finished"]:
+            return state["posts"]
+        user_posts = state["posts"]
+        after = state["after"]
 
         if not isinstance(start_time, float):
             start_time = int(start_time.replace(tzinfo=timezone.utc).timestamp())
@@ -159,7 +252,7 @@ class RedditApi(ApiInterface):
             end_time = int(end_time.replace(tzinfo=timezone.utc).timestamp())
 
         while len(user_posts) < number_of_messages:
-            url = url.format({"username": username})
+            url = listing_url
             if after:
                 url += f"&after={after}"
             logging.info(f"Fetching {username}'s posts")
@@ -169,16 +262,18 @@ class RedditApi(ApiInterface):
             except Exception as e:
                 if "404" in str(e):
                     logging.error(f"User {username} does not exists")
+                    self._save_state(content_type, username, {"after": None, "finished": True, "posts": []})
                     return []
                 if "403" in str(e):
                     logging.error(f"User {username} cannot be accessed")
+                    self._save_state(content_type, username, {"after": None, "finished": True, "posts": []})
                     return []
-                if "429" in str(e):
-                    raise Exception(e)
+                raise
 
             posts = response.get('data', {}).get('children', [])
 
             if not posts:
+                self._save_state(content_type, username, {"after": None, "finished": True, "posts": user_posts})
                 break
 
             for post in posts:
@@ -191,8 +286,62 @@ class RedditApi(ApiInterface):
                         break
 
             after = response.get('data', {}).get('after')
+            self._save_state(content_type, username, {
+                "after": after, "finished": not after or len(user_posts) >= number_of_messages, "posts": user_posts})
 
             if not after:
                 break
 
-        return user_posts
\ No newline at end of file
+        return user_posts
+
+    def _map_concurrently(self, fetch, items: list, max_workers: int = None) -> list:
+        """
+        Calls fetch on every item over a bounded thread pool sharing this client's session and token.
+
+        Returns:
+            list: the results of fetch in the order of items. The first error raised by a fetch is re-raised
+            once the fetches already running are done, and the pending ones are cancelled.
+        """
+        max_workers = max_workers or self.max_workers
+        if max_workers <= 1 or len(items) <= 1:
+            return [fetch(item) for item in items]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, item) for item in items]
+            try:
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def get_top_users_by_karma_concurrently(self, subreddits: list, limit: int = 100000, max_workers: int = None):
+        """
+        get_top_users_by_karma of several subreddits at the same time.
+
+        Returns:
+            dict: subreddit to its users sorted by karma, in the order of subreddits.
+        """
+        users = self._map_concurrently(lambda subreddit: self.get_top_users_by_karma(subreddit, limit), subreddits,
+                                       max_workers)
+        return dict(zip(subreddits, users))
+
+    def get_users_posts_within_timeframe(
+            self,
+            usernames: list,
+            number_of_messages: int,
+            start_time: datetime=float(0),
+            end_time: datetime=None,
+            posts: bool=True,
+            max_workers: int = None):
+        """
+        get_user_posts_within_timeframe of several users at the same time.
+
+        Returns:
+            dict: username to its posts (or comments), in the order of usernames.
+        """
+        end_time = time.time() if end_time is None else end_time
+        users_posts = self._map_concurrently(
+            lambda username: self.get_user_posts_within_timeframe(username, number_of_messages, start_time, end_time,
+                                                                  posts),
+            usernames, max_workers)
+        return dict(zip(usernames, users_posts))
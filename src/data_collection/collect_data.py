@@ -3,6 +3,8 @@ import os
 import logging
 from utils import Utils
 from data_collection.api import RedditApi
+from data_collection.crawl_state import CrawlState
+from data_collection.response_cache import ResponseCache
 from dotenv import load_dotenv
 
 import datetime
@@ -10,6 +12,8 @@ import time
 import functools
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,  # Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
@@ -22,6 +26,12 @@ logging.basicConfig(
 load_dotenv()
 config = Utils.read_json("./config/collection_config.json")["reddit"]
 AUTH_URL = config["auth_url"]
+BASE_URL = config.get("base_url", "https://oauth.reddit.com")
+MAX_WORKERS = config.get("max_workers", 8)  # users fetched at the same time by each client in collect_user_posts
+# e.g. {"cache_dir": "./data/http_cache", "max_size_mb": 1024}, see ResponseCache, absent to not cache responses
+RESPONSE_CACHE = config.get("response_cache")
+# directory of the crawl progress, so that an interrupted collection resumes where it stopped, absent to not save it
+CRAWL_STATE_DIR = config.get("crawl_state_dir")
 COLLECTION_CONFIGS = config["collection_configs"]
 
 # Define the decorator for handling errors
@@ -34,7 +44,7 @@ def handle_reddit_errors(func):
         except Exception as e:
             if "429" in str(e):  # Handle rate limit errors
                 logging.error(f"Rate limit error encountered: {e}. Switching credentials and retrying...")
-                time.sleep(8)
+                self.change_credentials()
                 return func(*args, **kwargs)  # Retry the function after switching credentials
             else:
                 logging.error(f"An error occurred: {e}")
@@ -46,44 +56,51 @@ class DataCollector:
             self, 
             reddit_credentials_list: list = [], 
             headers: dict = {"User-Agent": "ChangeMeClient/0.1 by YourUsername"}, 
-            timeout: float = 4) -> None:
+            timeout: float = 4,
+            max_workers: int = MAX_WORKERS) -> None:
         
         self.index = 0
         self.credentials_list = reddit_credentials_list
         self.headers = headers
         self.timeout = timeout
-        self.credentials = self.credentials_list[self.index]
-        self.auth_keys = [self.credentials["client_id"], self.credentials["client_secret"]]
-        self.username = self.credentials["username"]
-        self.password = self.credentials["password"]
-
-        self.reddit_client = RedditApi(
-            self.auth_keys,
-            self.username,
-            self.password,
+        self.max_workers = max_workers
+        # shared by the clients, so that a response fetched with any credential is reused by all
+        self.response_cache = ResponseCache(**RESPONSE_CACHE) if RESPONSE_CACHE else None
+        self.crawl_state = CrawlState(CRAWL_STATE_DIR) if CRAWL_STATE_DIR else None
+        # one authenticated client per credential, each with its own session, token and rate budget
+        self.clients = [self._make_client(credentials) for credentials in self.credentials_list]
+        self._use_client(self.index)
+
+    def _make_client(self, credentials: dict) -> RedditApi:
+        return RedditApi(
+            [credentials["client_id"], credentials["client_secret"]],
+            credentials["username"],
+            credentials["password"],
             AUTH_URL, 
             self.headers,
-            self.timeout
+            self.timeout,
+            BASE_URL,
+            self.max_workers,
+            response_cache=self.response_cache,
+            crawl_state=self.crawl_state
         )
 
-    def change_credentials(self):
-        if len(self.credentials_list) == 1:
-            logging.info("Only one set of credentials available. Waiting to avoid rate-limiting...")
-            time.sleep(8)  # wait some seconds to avoid flooding
-        elif self.index < len(self.credentials_list) - 2:
-            self.index += 1
-        else:
-            self.index -= 1
-
-        self.credentials = self.credentials_list[self.index]
+    def _use_client(self, index: int):
+        self.index = index
+        self.credentials = self.credentials_list[index]
         self.auth_keys = [self.credentials["client_id"], self.credentials["client_secret"]]
         self.username = self.credentials["username"]
         self.password = self.credentials["password"]
+        self.reddit_client = self.clients[index]
 
-        self.reddit_client.auth_keys = self.auth_keys
-        self.reddit_client.username = self.username
-        self.reddit_client.password = self.password
+    def change_credentials(self):
+        """Makes the next client of the pool the one used for the single requests, e.g. after a 429"""
+        if len(self.clients) == 1:
+            logging.info("Only one set of credentials available. Waiting to avoid rate-limiting...")
+            self.reddit_client.rate_limiter.backoff(self.reddit_client.max_retries)  # held by the client's rate limiter
+            return
 
+        self._use_client((self.index + 1) % len(self.clients))
         logging.info(f"Switched to credentials: {self.username}")
 
     def clean_posts(self, user_post):
@@ -139,13 +156,20 @@ class DataCollector:
             end_time = time.time()
         
         users_posts_list = []
+        # users are sharded across the clients of the pool, each fetching its shard concurrently within its own rate
+        # budget, and their posts are kept in the users order
+        usernames = [user["users"] for user in users]
+        shards = [(client, usernames[i::len(self.clients)]) for i, client in enumerate(self.clients)]
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            shards_posts = executor.map(
+                lambda shard: shard[0].get_users_posts_within_timeframe(
+                    shard[1], number_of_messages, start_time, end_time, posts, self.max_workers),
+                shards)
+            posts_by_user = {username: user_posts for shard_posts in shards_posts
+                             for username, user_posts in shard_posts.items()}
 
         for user in users:
-            logging.debug(f"Collecting posts for user: {user}")
-            users_posts = self.reddit_client.get_user_posts_within_timeframe(
-                user["users"], number_of_messages, start_time, end_time, posts)
-
-            for user_post in users_posts:
+            for user_post in posts_by_user[user["users"]]:
                 user_post = self.clean_posts(user_post)
                 user_post_data = {
                     **user_post,
@@ -165,8 +189,11 @@ class DataCollector:
         for config in COLLECTION_CONFIGS:
             subreddit = config["subreddit"]
             label = config["label"]
-            karma_threshold = config["karma_threshold"]
+            karma_threshold = config.get("karma_threshold", 0)
             number_of_posts_per_users = config["number_of_posts_per_users"]
+            if self.crawl_state is not None and self.crawl_state.finished("collection", subreddit):
+                logging.info(f"Skipping subreddit {subreddit}, already collected")
+                continue
             users_sample_size = (self.reddit_client.get_subreddit_member_count(subreddit)) * 0.1
 
             logging.info(f"Starting data collection for subreddit: {subreddit} \n ======== \n")
@@ -181,6 +208,8 @@ class DataCollector:
             
             posts = self.collect_user_posts(users_karma, number_of_posts_per_users)
             comments = self.collect_user_posts(users_karma, number_of_posts_per_users, posts=False)
+            if self.crawl_state is not None:
+                self.crawl_state.save("collection", subreddit, {"finished": True})
 
 def main():
     credentials_json = os.getenv('REDDIT_API_CREDENTIALS')
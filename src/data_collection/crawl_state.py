@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+
+
+class CrawlState:
+    """
+    Persistent progress of a crawl, so that a crawl stopped by a crash or a rate limit resumes where it stopped
+    instead of from scratch. Every paginated listing keeps its last `after` cursor, whether it is finished, and what
+    was collected from it so far, saved after each page.
+
+    A state belongs to one crawl: use a new state_dir to crawl again with other time windows or limits.
+
+    Layout:
+        {state_dir}/top/{subreddit}.json          {"after": ..., "finished": ..., "user_karma": {user: karma}}
+        {state_dir}/submitted/{username}.json     {"after": ..., "finished": ..., "posts": [...]}
+        {state_dir}/comments/{username}.json      same, for the comments
+        {state_dir}/collection/{subreddit}.json   {"finished": ...}, set once its users' posts and comments are saved
+    """
+
+    def __init__(self, state_dir: str) -> None:
+        self.state_dir = state_dir
+
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.state_dir, kind, f'{name}.json')
+
+    def load(self, kind: str, name: str) -> dict:
+        """
+        Returns:
+            dict: the saved state of the listing, or None if it was never started.
+        """
+        try:
+            with open(self._path(kind, name), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, kind: str, name: str, state: dict):
+        path = self._path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, a crash never leaves a half-written state
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def finished(self, kind: str, name: str) -> bool:
+        state = self.load(kind, name)
+        return state is not None and state.get("finished", False)
@@ -0,0 +1,98 @@
+import logging
+import random
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket pacing the requests of one Reddit client, shared by its threads.
+
+    Reddit reports the requests left in the current window and the seconds until it resets in the
+    X-Ratelimit-Remaining and X-Ratelimit-Reset headers of every response. After each response the bucket refills
+    at remaining / reset requests per second, so the budget is spread evenly over what is left of the window
+    instead of being burnt at once and waited out. Before the first response it refills at default_rate.
+    On a 429 or a 5xx every thread backs off, exponentially with jitter, or until the window resets.
+    """
+
+    def __init__(
+            self,
+            default_rate: float = 100 / 60,
+            burst: int = 8,
+            reserve: int = 8,
+            base_delay: float = 1,
+            max_delay: float = 60) -> None:
+        """
+        Parameters:
+            default_rate (float): requests per second until Reddit's headers are seen (100 per minute per client).
+            burst (int): most requests sent back to back, the bucket's capacity.
+            reserve (int): requests of the budget kept back for the ones in flight, not yet counted by Reddit.
+            base_delay, max_delay (float): bounds of the exponential backoff, in seconds.
+        """
+        self.default_rate = default_rate
+        self.rate = default_rate
+        self.burst = burst
+        self.reserve = reserve
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens = 1.0  # a first request goes out right away to read the headers
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.rate > 0 else 1)
+            time.sleep(wait)
+
+    def update(self, headers):
+        """Paces the next requests on the rate limit headers of a response"""
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            usable = remaining - self.reserve
+            if usable < 1:
+                # budget spent: nothing goes out until the window resets, then probe at the default rate
+                self.block(reset)
+                self.tokens = min(self.tokens, 0.0)
+                self.rate = self.default_rate
+                self.updated_at = self.blocked_until
+            else:
+                self.tokens = min(self.tokens, usable)
+                self.rate = usable / max(reset, 1)
+
+    def block(self, delay: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def backoff(self, attempt: int, headers=None):
+        """
+        Makes every thread wait after a failed request (429, 5xx or connection error), base_delay * 2 ** attempt
+        seconds with full jitter, or until the rate limit window resets when the response says when it does.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        try:
+            if headers is not None and float(headers["X-Ratelimit-Remaining"]) < 1:
+                delay = float(headers["X-Ratelimit-Reset"]) + random.uniform(0, self.base_delay)
+        except (KeyError, TypeError, ValueError):
+            pass
+        logging.warning(f"Backing off for {delay:.1f} seconds")
+        with self._lock:
+            self.block(delay)
+            self.tokens = min(self.tokens, 0.0)
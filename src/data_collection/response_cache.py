@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# seconds a response stays fresh, by the first pattern found in its url, 0 to never cache
+DEFAULT_TTLS = {
+    r"/r/[^/]+/about": 24 * 3600,  # subscriber counts
+    r"/r/[^/]+/top": 24 * 3600,  # all time top posts
+    r"/user/[^/]+/(submitted|comments)": 6 * 3600,
+    r".*": 3600,
+}
+
+
+class ResponseCache:
+    """
+    Persistent cache of the JSON bodies of GET requests, keyed by url, so that re-runs of a collection (during
+    development or after a crash) are served from disk instead of the API.
+
+    Entries expire after the TTL of their endpoint, and the least recently used ones are evicted once the cache
+    grows over max_size_mb. In replay mode entries never expire and a miss raises instead of reaching the API, so a
+    cache recorded from a real run can be replayed as a fixture by offline tests.
+
+    Layout:
+        {cache_dir}/{sha1(url)[:2]}/{sha1(url)}.json   {"url": ..., "fetched_at": ..., "body": ...}
+    """
+
+    def __init__(self, cache_dir: str, ttls: dict = None, max_size_mb: float = 1024, replay: bool = False) -> None:
+        self.cache_dir = cache_dir
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or DEFAULT_TTLS).items()]
+        self.max_size = max_size_mb * 2 ** 20
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._paths())
+
+    def _paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith('.json'):
+                    yield os.path.join(root, file)
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def ttl(self, url: str) -> float:
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def get(self, url: str):
+        """
+        Returns:
+            the cached body of url, or None if it is not cached or expired.
+        """
+        path = self._path(url)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+        if entry is None or entry['url'] != url or \
+                (not self.replay and time.time() - entry['fetched_at'] >= self.ttl(url)):
+            self.misses += 1
+            if self.replay:
+                raise Exception(f"No cached response for {url} to replay")
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)  # eviction goes by last use
+        except FileNotFoundError:
+            pass
+        return entry['body']
+
+    def put(self, url: str, body):
+        if self.replay or self.ttl(url) <= 0:
+            return
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'fetched_at': time.time(), 'body': body}, f)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.size += size - old_size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # least recently used entries first, down to 90% of max_size so that eviction doesn't run on every put
+        entries = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            n_evicted += 1
+        logging.info(f"Evicted {n_evicted} responses from the cache at {self.cache_dir}")